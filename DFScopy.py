@@ -31,234 +31,717 @@
 # and where we'll be copying.
 #								server:port:file_name  /our/machines/directory/file
 # Run in terminal:  python3 DFScopy.py localhost:1234:pajaro.jpg /home/User/pajaro.jpg
+# Only the first 4K:  python3 DFScopy.py localhost:1234:pajaro.jpg /home/User/head.jpg 8 0 4K
+
+# Without a destination the size and block size of the file are
+# printed, or of all the files starting with the prefix before a *:
+# Run in terminal:  python3 DFScopy.py localhost:1234:pajaro.jpg
+#                   python3 DFScopy.py "localhost:1234:/birds/*"
 
 
 # Copying to: 
-# Note, we do not need to specify DFS' directory, data-node takes care of it.
-# We want to know which file we want to copy and where to copy it to
+# We want to know which file we want to copy and where to copy it to,
+# the path in the DFS is optional: the name of the file in the top
+# directory by default.  Missing DFS directories are created.
 # You may use ls.py to see which available files we can copy
 
 # Run in terminal: python3 DFScopy.py ~/path/Pingu.txt localhost:1234
+# In a DFS directory: python3 DFScopy.py ~/path/Pingu.txt localhost:1234:/penguins/Pingu.txt
+# Optional block size (default 4M): python3 DFScopy.py ~/path/Pingu.txt localhost:1234 64M
+# Compressed with zlib: python3 DFScopy.py ~/path/Pingu.txt localhost:1234 4M 8 1 zlib
+# Erasure coded, 4 data and 2 parity blocks per stripe instead of copies:
+#	python3 DFScopy.py ~/path/Pingu.txt localhost:1234 4M 8 1 none 4+2
 
 
-import socket
 import sys
+import os
 import os.path
+import zlib
+import lzma
+import hashlib
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from Packet import *
+from ls import listFiles
+import erasure
+import logs
+
+log = logs.getLogger("copy")
 
 def usage():
 	print ("""
-	Usage:\n\tFrom DFS: python %s <server>:<port>:<dfs file path> <destination file>
-	\n\tTo DFS: python %s <source file> <server>:<port>:<dfs file path>
-	""" % (sys.argv[0], sys.argv[0]) )
+	Usage:\n\tFrom DFS: python %s <server>:<port>:<dfs file path> <destination file> <transfers, default=8> <offset> <length, default=to the end>
+	\n\tMany from DFS: python %s <server>:<port>:<dfs directory/name prefix>* <destination directory> <transfers, default=8>
+	\n\tStat: python %s <server>:<port>:<dfs file path, or dfs directory/name prefix*>
+	\n\tTo DFS: python %s <source file or directory> <server>:<port>:<dfs path, default=/source name> <block size, default=4M> <transfers, default=8> <copies, default=server's> <codec: zlib|lzma|none, default=none> <erasure: k+m|none, default=none>
+	""" % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0]) )
 	sys.exit(0)
 
-# getDataChunks divides a given data 
-# string into a specified number of equal-sized chunks.
-def getDataChunks(data, data_nodes):
-
-	chunks = []
-	# Calculate the amount of data per node
-	data_per_node = len(data) // data_nodes
-
-	# Iterate over the data nodes and create the chunks
-	for i in range(data_nodes):
-		# Calculate the start and end indices of the current chunk
-		start = i * data_per_node
-		end = start + data_per_node
-		
-		# Create the chunk and append it to the list
-		chunk = data[start:end]
-		chunks.append(chunk)
-
-	# Check if the sum of the lengths of the chunks is less than the
-	# length of the data. If so, add the remaining data to the last chunk.
-	len_sum = sum(len(chunk) for chunk in chunks)
-	if len_sum < len(data):
-		remainder = len(data) - len_sum
-		chunks[-1] += data[-remainder:]
-
-	return chunks
-
-
-# The copyToDFS function is used to copy a file 
-# from the local file system to the DFS. 
-# It establishes a connection to the metadata server, 
-# reads the contents of the file to be copied, 
-# and sends a put request packet to the 
-# server along with the file name and size. 
-# The metadata server responds with a 
-# list of data nodes where the file will be stored, 
-# and the copyToDFS function divides the file 
-# contents into equal-sized chunks and sends them to the data nodes. 
-def copyToDFS(address, fname):
-
-	# Create a connection to the metadata server
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Default size of the blocks a file is split in when
+# copied to the DFS, can be changed from the command line
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Default number of block transfers kept in flight at once
+# across all the data nodes
+TRANSFERS = 8
+
+# Codecs the blocks of a file may be compressed with, as
+# (compress, decompress) functions.  Both release the GIL, so
+# blocks are compressed and decompressed by several threads at once.
+CODECS = {
+	"zlib": (zlib.compress, zlib.decompress),
+	"lzma": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+
+# A file is only compressed if a sample of SAMPLE_SIZE bytes from
+# its start shrinks to less than COMPRESS_RATIO of its size
+SAMPLE_SIZE = 256 * 1024
+COMPRESS_RATIO = 0.9
+
+# Connections to the metadata server and the data nodes are kept
+# open and reused by the following requests, i.e. when copying
+# many small files from the same program
+connections = ConnectionPool()
+
+# parseSize turns a size such as 4096, 512K or 64M into bytes
+def parseSize(size):
+	units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+	size = size.strip().upper()
+	if size[-1:] in units:
+		return int(size[:-1]) * units[size[-1]]
+	return int(size)
+
+# parseErasure turns k+m, i.e. 4+2, into the (k, m) of stripes of
+# k data blocks and m parity blocks.  With one parity block, i.e.
+# 4+1, the parity is the XOR of the blocks.
+def parseErasure(spec):
+	try:
+		k, m = [int(n) for n in spec.split("+")]
+		erasure.parityRows(k, m)
+	except ValueError:
+		usage()
+	return k, m
+
+# parseCount validates a count given in the command line,
+# i.e. the number of blocks transferred at once
+def parseCount(count):
+	try:
+		count = int(count)
+	except ValueError:
+		usage()
+	if count <= 0:
+		usage()
+	return count
+
+# chooseCodec compresses a sample of the file with codec and
+# returns codec if it is worth it, None if the file compresses
+# poorly, i.e. it is already compressed.
+def chooseCodec(file, codec):
+	if codec is None:
+		return None
+	sample = file.read(SAMPLE_SIZE)
+	file.seek(0)
+	if not sample:
+		return None
+	compress, decompress = CODECS[codec]
+	if len(compress(sample)) > len(sample) * COMPRESS_RATIO:
+		return None
+	return codec
+
+# compressBlock returns the data to store for a block and the codec
+# it was compressed with, the block itself and None if the file is
+# not compressed or the block did not shrink.
+def compressBlock(codec, block):
+	if codec is None:
+		return block, None
+	data = CODECS[codec][0](block)
+	if len(data) >= len(block):
+		return block, None
+	return data, codec
+
+# decodeBlock decompresses a block and writes it at its offset in
+# the destination file descriptor.  Returns the bytes written.
+def decodeBlock(codec, data, length, fd, offset):
+	block = CODECS[codec][1](data)
+	if len(block) != length:
+		raise IOError("Block at %d: %d bytes decompressed, expected %d" % (offset, len(block), length))
+	writeBlock(fd, offset, block)
+	return length
+
+def writeBlock(fd, offset, block):
+	view = memoryview(block)
+	written = 0
+	while written < len(view):
+		written += os.pwrite(fd, view[written:], offset + written)
+
+# hashBlocks returns the SHA-256 hash of each block of a file,
+# blocks with the same hash are stored only once in the DFS
+def hashBlocks(file, bsize):
+	buf = bytearray(bsize)
+	view = memoryview(buf)
+	hashes = []
+	while True:
+		n = file.readinto(buf)
+		if not n:
+			break
+		hashes.append(hashlib.sha256(view[:n]).hexdigest())
+	file.seek(0)
+	return hashes
+
+# askChunks asks the metadata server which blocks are already
+# stored, by hash.  Returns, by hash, the chunk id, checksum,
+# codec, stored size and data nodes of each of them.
+def askChunks(address, hashes):
 	sp = Packet()
-	# Address
-	ip, port = address
-
-	# Read file
-	# Reads as rb
-	file = open(fname, 'rb')	
-	file_contents = file.read()
-	fsize = os.path.getsize(fname)
-
-
-	# Connect
-	sock.connect((ip, port))
-	# Create a Put packet with the fname and the length of the data,
-	# and sends it to the metadata server
-	sp.BuildPutPacket(fname, fsize)
-	sock.sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-	rec = sock.recv(1024).decode('UTF-8')
-
-	# sp.DecodePacket(rec)
-
-	if rec == "DUP":
-		print("Duplicate!")
-		exit()
+	sp.BuildHavePacket(hashes)
+	return connections.request(address, sp).getChunks()
+
+# readBlocks reads a file one block at a time into buffers
+# taken from a pool of reusable buffers and yields each buffer
+# with a view of the block read.  The buffer must be put back
+# in the pool once the block is sent, so no more blocks than
+# buffers in the pool are in memory, no matter how big the file is.
+def readBlocks(file, buffers):
+	while True:
+		buf = buffers.get()
+		n = file.readinto(buf)
+		if not n:
+			buffers.put(buf)
+			break
+		yield buf, memoryview(buf)[:n]
+
+# sendBlock sends one block of fname to the first data node of
+# its chain, which forwards it down the rest of the chain while
+# it is still receiving it.  If the first node fails the block is
+# sent to the next one, with the rest of the chain after it.
+# Returns the block ID the data nodes saved it with and the list
+# of nodes that saved it.
+def sendBlock(chain, fname, blockidx, block):
+	# The data nodes check the block against its checksum
+	crc = zlib.crc32(block)
+
+	for i in range(len(chain)):
+		sp = Packet()
+		sp.BuildPutPacket(fname, len(block))
+		sp.setBlockIndex(blockidx)
+		sp.setPipeline(chain[i + 1:])
+		sp.setChecksum(crc)
+
+		# The block is sent as the payload of the put packet,
+		# the data node answers with the block ID once it is saved
+		node = tuple(chain[i])
+		try:
+			rp = connections.request(node, sp, block)
+		except OSError as e:
+			log.warning("Block %d: sending it to %s failed: %s", blockidx, node, e)
+			continue
+		if rp.getStatus() != "NAK":
+			return rp.getBlockID(), rp.getDataNodes(), crc
+		log.warning("Block %d: %s could not save it", blockidx, node)
+
+	raise IOError("Block %d: no data node of its chain could save it" % blockidx)
+
+# fetchBlock asks the data nodes holding a block for it, one after
+# the other until one answers with a block that matches its
+# checksum (when known).  Returns a view of the block_size bytes
+# received.  With start, only the block_size bytes of the block
+# from start are asked for, and they are not checked.
+def fetchBlock(nodes, fname, blockidx, blockid, block_size, crc=None, start=None):
+	sp = Packet()
+	sp.BuildGetBlockPacket(fname, blockidx, blockid)
+	if start is not None:
+		sp.setRange(start, block_size)
+		crc = None
+
+	buf = bytearray(block_size)
+	view = memoryview(buf)
+
+	for node in nodes:
+		received = 0
+
+		# The block comes back as the payload of the response
+		try:
+			conn, rp = connections.exchange(node, sp)
+			try:
+				if rp.getStatus() != "NAK":
+					received = conn.reader.readPayloadInto(view)
+			except:
+				conn.close()
+				raise
+			connections.release(conn)
+		except OSError as e:
+			log.warning("Block %d: %s failed: %s", blockidx, node, e)
+
+		if received == block_size:
+			if crc is None or zlib.crc32(view) == crc:
+				break
+			log.warning("Block %d: %s sent a corrupt copy", blockidx, node)
 	else:
-		sp.DecodePacket(rec)
-
-	dataNodes = sp.getDataNodes()
-	# pair, address : odd , port
-	nodes = []
-	for addr, port in dataNodes:
-		print(f"Address: {addr} Port: {port}")
-		nodes.append( (addr, port) )
-	
-	print(f"Nodes: {nodes} \nNodes Len: {len(nodes)}")
-
-
-	# ---------------------- Setting Up To Send Data Contents  --------------
-
-		# ---------------------- First Splicing in Chunks  --------------
-
-	data_chunks = getDataChunks(file_contents, len(nodes))
-	# print(f"\nData_Chunks\n{data_chunks}\n")
-
-		# -----------------                               --------------
-
-	# Content from the file (file_contents), 
-	# prepared to be put in a packet. WORK-IN-PROGRESS
-
-	# List of Sockets to send file content(s) to Node(s)
-	send_contents_to_DN = [None] * len(nodes)
-	save_node_IDs 		= [None] * len(nodes)
-
-	for i in range(len(nodes)):
-
-		sp.BuildPutPacket(fname, len(data_chunks[i]))
-
-		# print(f"Working on Node: {nodes[i]}")
-		# Connecting to the node
-		send_contents_to_DN[i] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		print(f"Connecting to Node: {send_contents_to_DN[i]}")
-
-		send_contents_to_DN[i].connect(nodes[i])
-		
-		# Sending the data to the Node(s)
-		send_contents_to_DN[i].sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-		save_node_IDs[i] = send_contents_to_DN[i].recv(1024).decode('UTF-8')
-		send_contents_to_DN[i].sendall(data_chunks[i])
-		
-		print(f"Response after connecting to Data Node: \
-		{type(save_node_IDs[i])} {save_node_IDs[i]}\n")
-
-	# ---------------------- Finishing Confirm Data Read --------------
-	print("-----------------------------------------------------")
-
-
-
-# The copyFromDFS function is used to 
-# copy a file from the DFS to the local file system. 
-# It establishes a connection to the metadata server, 
-# sends a get request packet with the file name and size, 
-# and receives the file contents from the data nodes. 
-# It then writes the contents to a file in the local file system.
-def copyFromDFS(address, fname, path):
-
-	# Create a connection to the data server	
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		raise IOError("Block %d: no data node could send its %d bytes" % (blockidx, block_size))
+
+	return view
+
+# recvBlock fetches a block and writes it straight to its offset
+# in the destination file descriptor, so blocks can arrive in any
+# order.  Compressed blocks are handed to the decoders pool, the
+# transfer goes on with the next block while they are decompressed,
+# and the future of the decompression is returned.
+def recvBlock(nodes, fname, blockidx, blockid, length, fd, offset, crc=None, codec=None, stored=None, decoders=None):
+	if codec is None:
+		writeBlock(fd, offset, fetchBlock(nodes, fname, blockidx, blockid, length, crc))
+		return length
+
+	data = fetchBlock(nodes, fname, blockidx, blockid, stored, crc)
+	return decoders.submit(decodeBlock, codec, data, length, fd, offset)
+
+
+# readPart returns count bytes from start of one block of the
+# block map.  Only that part of the block is sent by the data
+# node, unless the block is compressed: then the whole block is
+# fetched and decompressed.
+def readPart(fname, block, start, count):
+	blockidx, offset, length, blockid, nodes, crc, codec, stored = block
+	first = blockidx % len(nodes)
+	nodes = nodes[first:] + nodes[:first]
+
+	if codec is not None:
+		data = CODECS[codec][1](fetchBlock(nodes, fname, blockidx, blockid, stored, crc))
+		return data[start:start + count]
+	if start == 0 and count == length:
+		return fetchBlock(nodes, fname, blockidx, blockid, length, crc)
+	return fetchBlock(nodes, fname, blockidx, blockid, count, start=start)
+
+# rebuildBlock returns a block of an erasure coded file that no
+# live data node holds anymore, decoded from the blocks and parity
+# blocks left of its stripe.  stripes is the (k, m, stripes) of the
+# get response, with the blocks of the stripe of block.
+def rebuildBlock(fname, stripes, block):
+	k, m, stripes = stripes
+	blockidx, offset, length = block[:3]
+	data, parity = stripes[blockidx // k]
+	first = blockidx // k * k
+
+	# Any k blocks of the stripe will do, data blocks first.
+	# The last stripe of a file may be short, the blocks past
+	# the end of the file are zeros.
+	pieces = {i: b"" for i in range(len(data), k)}
+	for member in data:
+		if len(pieces) == k:
+			break
+		if member[4] and member[0] != blockidx:
+			try:
+				pieces[member[0] - first] = bytes(readPart(fname, member, 0, member[2]))
+			except IOError as e:
+				log.warning("%s: stripe block not read: %s", fname, e)
+	for pidx, blockid, nodes, crc, size in parity:
+		if len(pieces) == k:
+			break
+		if nodes:
+			try:
+				pieces[k + pidx] = bytes(fetchBlock(nodes, fname, blockidx, blockid, size, crc))
+			except IOError as e:
+				log.warning("%s: parity block not read: %s", fname, e)
+
+	if len(pieces) < k:
+		raise IOError("Block %d: %d blocks of its stripe left, %d needed" % (blockidx, len(pieces), k))
+	log.info("%s: block %d rebuilt from its stripe", fname, blockidx)
+	# The first block of a stripe is the longest, the
+	# parity blocks are as long as it
+	return erasure.decode(pieces, k, m, data[0][2], [blockidx - first])[0][:length]
+
+# recvStriped receives a block of an erasure coded file like
+# recvBlock, but when no data node sends it, i.e. its node is down
+# and the metadata server does not know yet, or it sends a corrupt
+# copy, the block is rebuilt from the rest of its stripe
+def recvStriped(fname, stripes, block, fd, decoders):
+	blockidx, offset, length, blockid, nodes, crc, codec, stored = block
+	if nodes:
+		try:
+			return recvBlock(nodes, fname, blockidx, blockid, length, fd, offset, crc, codec, stored, decoders)
+		except IOError as e:
+			log.warning("%s: rebuilding block: %s", fname, e)
+	writeBlock(fd, offset, rebuildBlock(fname, stripes, block))
+	return length
+
+# readRange is the read API of the DFS: it returns up to length
+# bytes of fname from offset, all of them to the end of the file
+# when length is None.  The metadata server only returns the
+# blocks that overlap the range, and of each one only the part in
+# the range is read, so reading the header or tail of a huge file
+# moves little more than the bytes asked for.  Returns None if
+# the file is not in the DFS.
+def readRange(address, fname, offset, length=None, transfers=TRANSFERS):
 	sp = Packet()
-	print(f"fname: {fname} \n path: {path}")
-
-	# Address and Connection
-	ip, port = address
-	sock.connect((ip, port))
-
-   	# Contact the metadata server to ask for information of fname
 	sp.BuildGetPacket(fname)
-	sock.sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-	rec = sock.recv(1024).decode()
-	sp.DecodePacket(rec)
-
-	fname, fsize = sp.getFileInfo()
-	# print(f"fsize: {fsize}")
-
-	# Make a list of data-node addresses
-	dataNodes = sp.getDataNodes()
-	# pair, address : odd , port
-	nodes = []
-	for addr, port in dataNodes:
-		print(f"Address: {addr} Port: {port}")
-		nodes.append( (addr, port) )
-	
-	print(f"Nodes: {nodes}")
-	size_per_nodes = fsize // len(nodes)
-
-	# File entry
-	# Writes with append binary
-	file = open(path, 'ab+')
-
-	# ---------------------- Setting Up To Send Data Contents  --------------
-	# Content from the file (file_contents), 
-	# prepared to be put in a packet. WORK-IN-PROGRESS
-	# List of Sockets to send file content(s) to Node(s)
-	send_contents_to_DN = [None] * len(nodes)
-	save_node_content 	= [None] * len(nodes)
-
-	for i in range(len(nodes)):
+	sp.setRange(offset, length)
+	rp = connections.request(address, sp)
+
+	if rp.getStatus() == "NAK":
+		return None
+
+	fname, fsize = rp.getFileInfo()
+	end = fsize if length is None else min(fsize, offset + length)
+	data = bytearray(max(0, end - offset))
+
+	def read(block):
+		start = max(offset, block[1])
+		stop = min(end, block[1] + block[2])
+		part = None
+		if block[4]:
+			try:
+				part = readPart(fname, block, start - block[1], stop - start)
+			except IOError as e:
+				# Blocks of erasure coded files are rebuilt
+				if rp.getStripes() is None:
+					raise
+				log.warning("%s: rebuilding block: %s", fname, e)
+		if part is None:
+			part = rebuildBlock(fname, rp.getStripes(), block)[start - block[1]:stop - block[1]]
+		data[start - offset:stop - offset] = part
+
+	with ThreadPoolExecutor(max_workers=transfers) as pool:
+		for f in [pool.submit(read, block) for block in rp.getDataBlocks()]:
+			f.result()
+	return bytes(data)
+
+
+# batchRequest sends many requests to the metadata server in
+# batches of BATCH_SIZE, each batch is run in one transaction and
+# answered in one response.  Returns the responses in order.
+BATCH_SIZE = 256
+
+def batchRequest(address, packets):
+	results = []
+	for i in range(0, len(packets), BATCH_SIZE):
+		sp = Packet()
+		sp.BuildBatchPacket(packets[i:i + BATCH_SIZE])
+		results += connections.request(address, sp).getResults()
+	return results
+
+# statFiles returns the (size, block size, is directory) of each
+# file, None for the ones not in the DFS, asking for all of them
+# at once.
+def statFiles(address, fnames):
+	packets = []
+	for fname in fnames:
+		sp = Packet()
+		sp.BuildStatPacket(fname)
+		packets.append(sp)
+
+	stats = {}
+	for fname, rp in zip(fnames, batchRequest(address, packets)):
+		if rp.getStatus() == "NAK":
+			stats[fname] = None
+		else:
+			stats[fname] = (rp.getFileInfo()[1], rp.getBlockSize(), rp.isDir())
+	return stats
+
+# walkFiles yields the path of every file in the DFS under the
+# directory prefix starts with whose name starts with the rest of
+# prefix, going down into the directories found.
+def walkFiles(address, prefix):
+	for fname, fsize in listFiles(address, prefix, pool=connections):
+		if fname.endswith("/"):
+			yield from walkFiles(address, fname)
+		else:
+			yield fname
+
+
+# The copyManyToDFS function is used to copy files
+# from the local file system to the DFS, given a list
+# of (source path, dfs file path).
+# It sends the put requests of all the files to the
+# metadata server in one batch, with their paths, sizes
+# and block size.  The metadata server responds with the
+# chain of data nodes where each block will be stored,
+# and the blocks of all the files are streamed to the data
+# nodes, up to transfers at once, as soon as they are read.
+# The block lists of all the files are committed in one
+# batch at the end, the puts of the files that could not be
+# saved whole are aborted.  Returns the files copied.
+# With erasure, a (k, m), the files are erasure coded instead of
+# replicated: each stripe of k blocks goes to k data nodes, and
+# its m parity blocks, computed while the blocks are read, to m
+# other nodes.  Erasure coded blocks are not deduplicated, the
+# blocks of a stripe must be in different nodes.
+def copyManyToDFS(address, paths, bsize=BLOCK_SIZE, transfers=TRANSFERS, replicas=None, codec=None, erasure_code=None):
+
+	# Create a Put packet for each file with the fname, the length
+	# of the data and the block size, and sends them to the
+	# metadata server
+	packets = []
+	for path, fname in paths:
+		sp = Packet()
+		sp.BuildPutPacket(fname, os.path.getsize(path), bsize)
+		if replicas:
+			sp.setReplicas(replicas)
+		if erasure_code:
+			sp.setErasure(*erasure_code)
+		packets.append(sp)
+
+	# The chain of data nodes of each block, the first node
+	# forwards the block to the next ones
+	files = []
+	for (path, fname), sp in zip(paths, batchRequest(address, packets)):
+		if sp.getStatus() == "DUP":
+			log.warning("%s: Duplicate!", fname)
+		elif sp.getStatus() == "NAK":
+			log.error("The metadata server can not save %s: the path is not valid or there are not enough data nodes", fname)
+		else:
+			files.append( (path, fname, sp.getChains(), sp.getParity()) )
+
+
+	# ---------------------- Finding the Blocks Already Stored --------------
+	# The blocks are hashed first, blocks with the same contents
+	# as one already in the DFS, or as an earlier block, are not
+	# sent again.  A chunk already stored is only reused if it has
+	# as many copies in live data nodes as the chains of the put,
+	# the copies asked for, otherwise the block is sent through its
+	# chain like the others.
+	hashes = {}
+	known = {}
+	if erasure_code:
+		for path, fname, chains, parity_chains in files:
+			hashes[fname] = [None] * len(chains)
+	else:
+		for path, fname, chains, parity_chains in files:
+			with open(path, 'rb') as file:
+				hashes[fname] = hashBlocks(file, bsize)
+		copies = max([len(chain) for path, fname, chains, parity_chains in files for chain in chains] or [0])
+		stored = askChunks(address, list({h for fname in hashes for h in hashes[fname]}))
+		known = {h: chunk for h, chunk in stored.items() if len(chunk[4]) >= copies}
+		log.info("Blocks already stored: %d", sum(h in known for fname in hashes for h in hashes[fname]))
+		if len(known) < len(stored):
+			log.info("Chunks stored with less than %d copies, sent again: %d", copies, len(stored) - len(known))
+
+
+	# ---------------------- Streaming the Blocks to the Data Nodes --------------
+
+	# A file can have many more blocks than there are data nodes.
+	# Up to transfers blocks are in flight at once, each one in
+	# its own buffer.  No bigger than the largest file and no more
+	# than the blocks to send, so small files do not pay for
+	# allocating transfers full blocks.
+	largest = max([os.path.getsize(path) for path, fname, chains, parity_chains in files] or [0])
+	nblocks = sum(len(chains) + sum(map(len, parity_chains or [])) for path, fname, chains, parity_chains in files)
+	buffers = queue.Queue()
+	for i in range(max(1, min(transfers, nblocks))):
+		buffers.put(bytearray(min(bsize, largest)))
+
+	# Blocks are compressed, if the file is, by the
+	# thread that sends them
+	def transfer(chain, fname, i, buf, block, codec):
+		try:
+			data, block_codec = compressBlock(codec, block)
+			blockid, nodes, crc = sendBlock(chain, fname, i, data)
+			return blockid, nodes, crc, block_codec, len(data)
+		finally:
+			buffers.put(buf)
+
+	# Erasure coded blocks are pending by file and index,
+	# the others by hash.  The parity blocks of each stripe
+	# are sent, from buffers of the pool too, once its last
+	# block is read.
+	pending = {}
+	with ThreadPoolExecutor(max_workers=transfers) as pool:
+		for path, fname, chains, parity_chains in files:
+			with open(path, 'rb') as file:
+				file_codec = chooseCodec(file, codec)
+				log.debug("%s: %d blocks, codec %s", fname, len(chains), file_codec or "none")
+				for i, (buf, block) in enumerate(readBlocks(file, buffers)):
+					if erasure_code:
+						k, m = erasure_code
+						stripe = i // k
+						if i % k == 0:
+							encoder = erasure.Encoder(k, m, len(block))
+						encoder.add(i % k, block)
+						pending[(fname, i)] = pool.submit(transfer, chains[i], fname, i, buf, block, file_codec)
+						if i % k == k - 1 or i == len(chains) - 1:
+							for j, data in enumerate(encoder.parity()):
+								pbuf = buffers.get()
+								pbuf[:len(data)] = data
+								blockidx = len(chains) + stripe * m + j
+								pending[(fname, stripe, j)] = pool.submit(transfer, [parity_chains[stripe][j]], fname, blockidx, pbuf, memoryview(pbuf)[:len(data)], None)
+						continue
+					blockhash = hashes[fname][i]
+					if blockhash in known or blockhash in pending:
+						buffers.put(buf)
+						continue
+					pending[blockhash] = pool.submit(transfer, chains[i], fname, i, buf, block, file_codec)
+
+
+	# ---------------------- Committing the Block Lists --------------
+	# One dblks packet per file with every copy of every block:
+	# index, node, block ID, checksum, codec, stored size and hash,
+	# and every parity block: stripe, parity index, node, block ID,
+	# checksum and size
+	packets = []
+	saved = []
+	failed = []
+	for path, fname, chains, parity_chains in files:
+		blocks = []
+		parity = []
+		try:
+			for i, blockhash in enumerate(hashes[fname]):
+				if blockhash in known:
+					blockid, crc, block_codec, stored, nodes = known[blockhash]
+				else:
+					blockid, nodes, crc, block_codec, stored = pending[blockhash or (fname, i)].result()
+				for node_addr, node_port in nodes:
+					blocks.append( (i, node_addr, node_port, blockid, crc, block_codec, stored, blockhash) )
+			for stripe, chain in enumerate(parity_chains or []):
+				for j in range(len(chain)):
+					blockid, nodes, crc, block_codec, stored = pending[(fname, stripe, j)].result()
+					for node_addr, node_port in nodes:
+						parity.append( (stripe, j, node_addr, node_port, blockid, crc, stored) )
+		except IOError as e:
+			log.error("%s: %s", fname, e)
+			failed.append(fname)
+			continue
+
+		sp = Packet()
+		sp.BuildDataBlockPacket(fname, blocks, parity)
+		packets.append(sp)
+		saved.append(fname)
+
+	copied = []
+	for fname, rp in zip(saved, batchRequest(address, packets)):
+		if rp.getStatus() != "ACK":
+			log.error("The metadata server could not save the block list of %s", fname)
+			failed.append(fname)
+		else:
+			copied.append(fname)
+
+	# The files not copied are removed from the DFS, they would
+	# be there with no blocks and their paths could not be put again
+	packets = []
+	for fname in failed:
+		sp = Packet()
+		sp.BuildAbortPacket(fname)
+		packets.append(sp)
+	for fname, rp in zip(failed, batchRequest(address, packets)):
+		if rp.getStatus() != "ACK":
+			log.warning("%s: the put could not be aborted", fname)
+	return copied
 
-		sp.BuildGetPacket(fname)
-		print(f"Working on Node: {nodes[i]}")
-		# Connecting to the node
-		send_contents_to_DN[i] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		print(f"Connecting to Node: {send_contents_to_DN[i]}")
+# The copyToDFS function is used to copy a file 
+# from the local file system to the DFS path fname. 
+def copyToDFS(address, path, fname, bsize=BLOCK_SIZE, transfers=TRANSFERS, replicas=None, codec=None, erasure_code=None):
+	if not copyManyToDFS(address, [(path, fname)], bsize, transfers, replicas, codec, erasure_code):
+		exit()
 
-		send_contents_to_DN[i].connect(nodes[i])
-		
-		# Sending the data to the Node(s)
-		send_contents_to_DN[i].sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-		# If there is no error response Retreive the data blocks
-		# save_node_content[i] = send_contents_to_DN[i].recv(1024).decode('UTF-8')
+	# ---------------------- Finishing Confirm Data Read --------------
+	log.info("Copied %s to %s", path, fname)
 
-		save_node_content[i] = send_contents_to_DN[i].recv(1024)
-		node_chunk = save_node_content[i]
 
-		print(f"\n{len(node_chunk)} \t fsize: {fsize}")
-		while( len(node_chunk) < size_per_nodes):
-			node_chunk += send_contents_to_DN[i].recv(1024)
-			# print(f"Chunk Received: {node_chunk}")
-			print(f"Chunk Received: {len(node_chunk)} \
-				\t Total Chunk Size: {size_per_nodes}")
 
+# The copyManyFromDFS function is used to copy files
+# from the DFS to the local file system, given a list
+# of (dfs file name, destination path).
+# It sends the get requests of all the files to the
+# metadata server in one batch, and receives the blocks
+# of the files from all the data nodes at once, writing
+# each block at its offset in its local file.
+# Returns the files copied.
 
-		print(f"\nSave Node Content {i} \t{len(save_node_content[i])}")
-		# print(f"\nSaving the whole chunk: {len(node_chunk)}")
-		# Save the file's content
-		file.write(node_chunk)
-		print(f"Response after connecting to Data Node: \
-			{type(save_node_content[i])} {save_node_content[i]}\n")
+# Destination files open at once while their blocks arrive
+OPEN_FILES = 64
 
+def copyManyFromDFS(address, files, transfers=TRANSFERS):
 
+	# Contact the metadata server to ask for the block
+	# map of every file
+	packets = []
+	for fname, path in files:
+		sp = Packet()
+		sp.BuildGetPacket(fname)
+		packets.append(sp)
+	responses = batchRequest(address, packets)
+
+	# ---------------------- Receiving the Blocks from the Data Nodes --------------
+	# Only the nodes holding a block are asked for it, up to
+	# transfers blocks are fetched at once from all the nodes.
+	# Compressed blocks are decompressed by their own pool of
+	# threads, one per CPU, so decompressing does not hold up
+	# the transfers.
+	copied = []
+	opened = collections.deque()
+
+	# Waits for the blocks of the oldest file still open
+	# Every block is waited for, even after one failed, before
+	# the file is closed.  A file not copied whole is removed,
+	# it would have zeros in place of the blocks missing.
+	def finish():
+		fname, path, fd, pending = opened.popleft()
+		error = None
+		for f in pending:
+			try:
+				received = f.result()
+				if not isinstance(received, int):
+					received.result()
+			except IOError as e:
+				error = e
+		os.close(fd)
+		if error is not None:
+			log.error("%s: %s", fname, error)
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+		else:
+			copied.append(fname)
+
+	with ThreadPoolExecutor(max_workers=transfers) as pool, ThreadPoolExecutor(max_workers=os.cpu_count()) as decoders:
+		for (fname, path), sp in zip(files, responses):
+			if sp.getStatus() == "NAK":
+				log.error("%s is not in the DFS, or not all its blocks are in live data nodes", fname)
+				continue
+
+			fsize = sp.getFileInfo()[1]
+
+			# The block map: index, offset, length, block ID, the data
+			# nodes holding each block, its checksum, the codec it is
+			# compressed with and its stored size, in file order
+			blocks = sp.getDataBlocks()
+			log.debug("%s: %d blocks", fname, len(blocks))
+
+			while len(opened) >= OPEN_FILES:
+				finish()
+
+			# File entry
+			# Blocks are written at their offset, not appended
+			fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+			os.ftruncate(fd, fsize)
+			pending = []
+			stripes = sp.getStripes()
+			for block in blocks:
+				blockidx, offset, length, blockid, nodes, crc, codec, stored = block
+				# Blocks of an erasure coded file are rebuilt from
+				# the rest of their stripe if they can not be read
+				if stripes is not None:
+					pending.append( pool.submit(recvStriped, fname, stripes, block, fd, decoders) )
+					continue
+				# Reads are spread over the copies of the blocks
+				first = blockidx % len(nodes)
+				nodes = nodes[first:] + nodes[:first]
+				pending.append( pool.submit(recvBlock, nodes, fname, blockidx, blockid, length, fd, offset, crc, codec, stored, decoders) )
+			opened.append( (fname, path, fd, pending) )
+
+		while opened:
+			finish()
+
+	return copied
 
-	file.close()
+# The copyFromDFS function is used to 
+# copy a file from the DFS to the local file system. 
+def copyFromDFS(address, fname, path, transfers=TRANSFERS):
+	if not copyManyFromDFS(address, [(fname, path)], transfers):
+		exit()
 
 	# ---------------------- Finishing Confirm Data Read --------------
-	print("-----------------------------------------------------")
+	log.info("Copied %s to %s", fname, path)
+
 
 # parses the command line arguments to 
 # determine the copy mode and extract 
@@ -266,10 +749,32 @@ def copyFromDFS(address, fname, path):
 # the metadata server address, file name, and file path. 
 # It then calls the appropriate main function for the copy operation.
 if __name__ == "__main__":
-	if len(sys.argv) < 3:
+	if len(sys.argv) < 2 or (len(sys.argv) < 3 and len(sys.argv[1].split(":")) < 3):
 		usage()
 
+	logs.setup()
+
 	file_from = sys.argv[1].split(":")
+
+	# Only a DFS path: the sizes of the file, or of all the files
+	# matching the prefix before the *, asked for in one batch
+	if len(sys.argv) == 2:
+		ip = file_from[0]
+		port = int(file_from[1])
+		from_path = file_from[2]
+		if from_path.endswith("*"):
+			fnames = list(walkFiles((ip, port), from_path[:-1]))
+		else:
+			fnames = [from_path]
+		for fname, stat in statFiles((ip, port), fnames).items():
+			if stat is None:
+				print(f"{fname} is not in the DFS")
+			elif stat[2]:
+				print(f"{fname} is a directory")
+			else:
+				print(f"{fname} {stat[0]} bytes, blocks of {stat[1]} bytes")
+		sys.exit(0)
+
 	file_to = sys.argv[2].split(":")
 
 	if len(file_from) > 1:
@@ -278,12 +783,52 @@ if __name__ == "__main__":
 		from_path = file_from[2]
 		to_path = sys.argv[2]
 
+		# Optional number of blocks transferred at once
+		transfers = TRANSFERS
+		if len(sys.argv) > 3:
+			transfers = parseCount(sys.argv[3])
+
+		# Many files, the ones in the DFS directory whose name
+		# starts with the prefix before the *, and all the files
+		# under the directories among them, are copied to the
+		# to_path directory
+		if from_path.endswith("*"):
+			os.makedirs(to_path, exist_ok=True)
+			top = "/" + from_path[:-1].lstrip("/").rpartition("/")[0]
+			files = []
+			for fname in walkFiles((ip, port), from_path[:-1]):
+				path = os.path.join(to_path, os.path.relpath(fname, top))
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				files.append( (fname, path) )
+			copied = copyManyFromDFS((ip, port), files, transfers)
+			print(f"Copied {len(copied)} of {len(files)} files")
+			sys.exit(0)
+
 		if os.path.isdir(to_path):
 			print("Error: path %s is a directory.  \
 				Please name the file." % to_path)
 			usage()
 
-		copyFromDFS((ip, port), from_path, to_path)
+		# Optional byte range, i.e. 0 4K for the first 4K of the
+		# file, only those bytes are read and copied
+		if len(sys.argv) > 4:
+			try:
+				offset = parseSize(sys.argv[4])
+				length = parseSize(sys.argv[5]) if len(sys.argv) > 5 else None
+			except ValueError:
+				usage()
+			if offset < 0 or (length is not None and length < 0):
+				usage()
+
+			data = readRange((ip, port), from_path, offset, length, transfers)
+			if data is None:
+				print("Error: %s is not in the DFS, or not all its blocks are in live data nodes" % from_path)
+				exit()
+			with open(to_path, 'wb') as f:
+				f.write(data)
+			print(f"Read {len(data)} bytes at {offset}")
+		else:
+			copyFromDFS((ip, port), from_path, to_path, transfers)
 
 	# elif len(file_to) > 2:
 	else:
@@ -291,13 +836,63 @@ if __name__ == "__main__":
 		port = int(file_to[1])
 		from_path = sys.argv[1]
 
+		# Path in the DFS, the name of the source in the
+		# top directory if not given
+		to_path = file_to[2] if len(file_to) > 2 else ""
+		if not to_path:
+			to_path = "/" + os.path.basename(os.path.normpath(from_path))
+
+		# Optional block size, i.e. 65536, 512K or 64M
+		bsize = BLOCK_SIZE
+		if len(sys.argv) > 3:
+			try:
+				bsize = parseSize(sys.argv[3])
+			except ValueError:
+				usage()
+			if bsize <= 0:
+				usage()
+
+		transfers = TRANSFERS
+		if len(sys.argv) > 4:
+			transfers = parseCount(sys.argv[4])
+
+		# Optional number of copies of each block,
+		# the metadata server's default otherwise
+		replicas = None
+		if len(sys.argv) > 5:
+			replicas = parseCount(sys.argv[5])
+
+		# Optional codec to compress the blocks with,
+		# files that compress poorly are not compressed
+		codec = None
+		if len(sys.argv) > 6 and sys.argv[6] != "none":
+			codec = sys.argv[6]
+			if codec not in CODECS:
+				usage()
+
+		# Optional erasure coding, i.e. 4+2: stripes of 4 blocks
+		# in 4 data nodes and 2 parity blocks in 2 more nodes,
+		# instead of copies of each block
+		erasure_code = None
+		if len(sys.argv) > 7 and sys.argv[7] != "none":
+			erasure_code = parseErasure(sys.argv[7])
+
+		# A directory: all the files in it are copied at once,
+		# each to the same path under the DFS directory
 		if os.path.isdir(from_path):
-			print("Error: path %s is a directory.  \
-				Please name the file." % from_path)
-			usage()
+			paths = []
+			for root, dirs, names in os.walk(from_path):
+				dirs.sort()
+				for name in sorted(names):
+					path = os.path.join(root, name)
+					rel = os.path.relpath(path, from_path).replace(os.sep, "/")
+					paths.append( (path, to_path.rstrip("/") + "/" + rel) )
+			copied = copyManyToDFS((ip, port), paths, bsize, transfers, replicas, codec, erasure_code)
+			print(f"Copied {len(copied)} of {len(paths)} files")
+			sys.exit(0)
 
 		# Note, we just specify what file we
 		# want to copy and the function
 		# takes care of the rest 
 		# (communicating to DFS to save it with it)
-		copyToDFS((ip, port), from_path)
+		copyToDFS((ip, port), from_path, to_path, bsize, transfers, replicas, codec, erasure_code)
@@ -6,20 +6,129 @@
 # 	Packet creation support library for the DFS project. Database info for
 #
 # Please modify globals with appropiate info.
+#
+# Wire format:
+# 	Every message is sent as a frame.  A fixed header with the message
+# 	type, the length of the packet and the length of the payload,
+# 	followed by the packet encoded in binary with marshal, followed by
+# 	the raw payload (i.e. the data of a block) if any.
+#
+# 	| type (1) | packet length (4) | payload length (8) | packet | payload |
+#
+# 	The message type is the position of the command in Packet.commands
+# 	plus one, responses are type 0.
+#
+# 	Frames come from the network: a packet longer than MAX_PACKET, cut
+# 	short, or that does not decode to a dict of plain values closes the
+# 	connection (ConnectionError).
+#
+# 	A connection carries any number of requests, one after the other,
+# 	each answered before the next is sent.  Clients keep connections
+# 	open in a ConnectionPool to reuse them.
+
+import marshal
+import struct
+import socket
+import threading
+import time
+
+# Fixed frame header: message type, packet length, payload length
+FRAME_HEADER = struct.Struct("!BIQ")
+
+# marshal format version used to encode packets
+MARSHAL_VERSION = 4
+
+# Longest packet accepted, a frame header announcing a longer one
+# closes the connection instead of making the reader allocate it
+MAX_PACKET = 64 * 1024 * 1024
+
+# Types a decoded packet may hold.  marshal also decodes code objects,
+# sets and others that no packet has, packets come from the network.
+PACKET_TYPES = (type(None), bool, int, float, str, bytes, tuple, list, dict)
+
+# Message type of responses
+RESPONSE = 0
+
+# Seconds the servers keep an idle connection open waiting for the
+# next request.  Pools drop their idle connections a bit before.
+IDLE_TIMEOUT = 60
+
+
+def sendBuffers(sock, buffers):
+	"""Sends all the buffers through the socket as a single write,
+	without joining them first.  Returns the number of bytes sent."""
+	views = [memoryview(b).cast("B") for b in buffers if len(b)]
+	total = sum(len(view) for view in views)
+	while views:
+		sent = sock.sendmsg(views)
+		while sent:
+			if sent >= len(views[0]):
+				sent -= len(views[0])
+				views.pop(0)
+			else:
+				views[0] = views[0][sent:]
+				sent = 0
+	return total
+
+def checkPacket(packet):
+	"""Raises ValueError unless a decoded packet is a dict of only the
+	types in PACKET_TYPES."""
+	if type(packet) is not dict:
+		raise ValueError("Packet is a %s, not a dict" % type(packet).__name__)
+	values = [packet]
+	while values:
+		value = values.pop()
+		if type(value) not in PACKET_TYPES:
+			raise ValueError("Packet holds a %s" % type(value).__name__)
+		if type(value) is dict:
+			values.extend(value.keys())
+			values.extend(value.values())
+		elif type(value) in (tuple, list):
+			values.extend(value)
 
-import json
 
 class Packet:
 
 	def __init__(self):
 	
-		self.commands = ["reg", "list", "put", "get", "dblks"]
+		self.commands = ["reg", "list", "put", "get", "dblks", "hb", "have", "stat", "batch", "mkdir", "rename", "stats", "abort"]
 		self.packet = {}
+		self.payload_len = 0
 		
 	def getEncodedPacket(self):
 		"""returns a seriliazed packet ready to send through the network.  
 		First you need to build the packets.  See BuildXPacket functions."""
-		return json.dumps(self.packet) 
+		packet = dict(self.packet)
+		packet.pop("command", None)
+		return marshal.dumps(packet, MARSHAL_VERSION)
+
+	def getMessageType(self):
+		"""Returns the message type of the packet for the frame header"""
+		cmd = self.getCommand()
+		if cmd in self.commands:
+			return self.commands.index(cmd) + 1
+		return RESPONSE
+
+	def getFrame(self, payload_len=0):
+		"""Returns the frame header and the encoded packet, ready to be
+		followed by payload_len bytes of payload."""
+		body = self.getEncodedPacket()
+		return FRAME_HEADER.pack(self.getMessageType(), len(body), payload_len) + body
+
+	def sendPacket(self, sock, payload=b""):
+		"""Sends the packet and its payload through sock in one frame.
+		Returns the number of bytes sent."""
+		return sendBuffers(sock, [self.getFrame(len(payload)), payload])
+
+	def sendHeader(self, sock, payload_len):
+		"""Sends the packet announcing payload_len bytes of payload, which
+		the caller sends right after (i.e. with socket.sendfile).  Returns
+		the number of bytes sent."""
+		return sendBuffers(sock, [self.getFrame(payload_len)])
+
+	def getPayloadSize(self):
+		"""Returns the length of the payload that followed a received packet"""
+		return self.payload_len
 
 	def getCommand(self):
 		"""Returns the command type of a packet"""
@@ -38,22 +147,59 @@ class Packet:
 			return self.packet["port"]
 		return None
 
-	def DecodePacket(self, packet):
-		"""Receives a serialized message and turns it into a packet object."""
-		self.packet = json.loads(packet)	
+	def DecodePacket(self, packet, mtype=RESPONSE, payload_len=0):
+		"""Receives a serialized message and turns it into a packet object.
+		Raises ConnectionError if it is not a valid packet, the connection
+		it came from can not be trusted anymore."""
+		try:
+			packet = marshal.loads(packet)
+			checkPacket(packet)
+		except (ValueError, EOFError, TypeError) as e:
+			raise ConnectionError("Bad packet: %s" % e)
+		self.packet = packet
+		if 0 < mtype <= len(self.commands):
+			self.packet["command"] = self.commands[mtype - 1]
+		self.payload_len = payload_len
 
 	def BuildRegPacket(self, addr, port):
 		"""Builds a registration packet"""
 		self.packet = {"command": "reg", "addr": addr, "port": port}
 		
 
-	def BuildListPacket(self):
-		"""Builds a list packet for file listing"""
+	def BuildHeartbeatPacket(self, addr, port, free, blocks, inflight):
+		"""Builds a heartbeat packet: a data node's free bytes, number of
+		blocks and transfers in flight"""
+		self.packet = {"command": "hb", "addr": addr, "port": port,
+			"free": free, "blocks": blocks, "inflight": inflight}
+
+	def getLoad(self):
+		"""Returns the (free bytes, blocks, transfers in flight) of a heartbeat"""
+		return self.packet.get("free"), self.packet.get("blocks", 0), self.packet.get("inflight", 0)
+
+	def BuildListPacket(self, prefix="", cursor=None, limit=None):
+		"""Builds a list packet for file listing.  Only the entries of the
+		directory prefix starts with whose name starts with the rest of
+		prefix, i.e. /logs/2024-, after the cursor of the previous page, and
+		at most limit of them (the server's page size if None)."""
 		self.BuildCommand("list")
+		self.packet["prefix"] = prefix
+		if cursor is not None:
+			self.packet["cursor"] = cursor
+		if limit is not None:
+			self.packet["limit"] = limit
 
-	def BuildListResponse(self, lfiles):
-		"""Builds a list response packet"""
-		self.packet = {"files": lfiles}	
+	def getListQuery(self):
+		"""Returns the (prefix, cursor, limit) of a list packet."""
+		return self.packet.get("prefix", ""), self.packet.get("cursor"), self.packet.get("limit")
+
+	def BuildListResponse(self, lfiles, cursor=None):
+		"""Builds a list response packet, with the cursor to ask for the next
+		page, None if it is the last one"""
+		self.packet = {"files": lfiles, "cursor": cursor}
+
+	def getCursor(self):
+		"""Returns the cursor of the next page of a list response"""
+		return self.packet.get("cursor")
 
 	def getFileArray(self):
 		"""Builds a list response packet"""
@@ -66,27 +212,180 @@ class Packet:
 		self.BuildCommand("get")
 		self.packet["fname"] = fname
 
-	def BuildPutPacket(self, fname, fsize):
-		"""Builds a put packet to put fname and file size."""
+	def BuildPutPacket(self, fname, fsize, bsize=None):
+		"""Builds a put packet to put fname and file size.  The block size
+		is optional, data nodes do not need it."""
 		self.BuildCommand("put")
 		self.packet["fname"] = fname
 		self.packet["fsize"] = fsize
+		if bsize is not None:
+			self.packet["bsize"] = bsize
+
 
+	def BuildAbortPacket(self, fname):
+		"""Builds an abort packet, removing fname from the DFS when a put of
+		it is given up before its blocks were committed."""
+		self.BuildCommand("abort")
+		self.packet["fname"] = fname
+
+	def BuildStatPacket(self, fname):
+		"""Builds a stat packet, asking the size of fname."""
+		self.BuildCommand("stat")
+		self.packet["fname"] = fname
+
+	def BuildStatResponse(self, fname, fsize, bsize, isdir=False):
+		"""Builds the response of a stat packet: path, size, block size and
+		if it is a directory."""
+		self.packet = {"fname": fname, "fsize": fsize, "bsize": bsize, "isdir": isdir}
+
+	def isDir(self):
+		"""Returns if a stat response is of a directory."""
+		return self.packet.get("isdir", False)
+
+	def BuildMkdirPacket(self, path):
+		"""Builds a mkdir packet, creating the directory path and the missing
+		directories above it."""
+		self.BuildCommand("mkdir")
+		self.packet["fname"] = path
+
+	def BuildRenamePacket(self, src, dst):
+		"""Builds a rename packet, moving the file or directory src to dst."""
+		self.BuildCommand("rename")
+		self.packet["fname"] = src
+		self.packet["dst"] = dst
+
+	def getRename(self):
+		"""Returns the (source, destination) paths of a rename packet."""
+		return self.packet.get("fname"), self.packet.get("dst")
+
+	def BuildBatchPacket(self, packets):
+		"""Builds a batch packet with the requests of many packets, i.e. the
+		puts of many files.  They are run in one database transaction and
+		answered in one response."""
+		self.BuildCommand("batch")
+		self.packet["batch"] = [p.packet for p in packets]
+
+	def getBatch(self):
+		"""Returns the requests of a batch packet, as packets."""
+		packets = []
+		for request in self.packet.get("batch", []):
+			p = Packet()
+			p.packet = dict(request)
+			packets.append(p)
+		return packets
+
+	def BuildBatchResponse(self, responses):
+		"""Builds the response of a batch packet, with the response of each
+		request in order."""
+		self.packet = {"results": [p.packet for p in responses]}
+
+	def getResults(self):
+		"""Returns the responses of a batch response, as packets."""
+		results = []
+		for response in self.packet.get("results", []):
+			p = Packet()
+			p.packet = response
+			results.append(p)
+		return results
+
+	def BuildHavePacket(self, hashes):
+		"""Builds a have packet, asking which of the block hashes (SHA-256
+		of the contents) are already stored in the DFS."""
+		self.BuildCommand("have")
+		self.packet["hashes"] = hashes
+
+	def getHashes(self):
+		"""Returns the block hashes of a have packet."""
+		if "hashes" in self.packet:
+			return self.packet["hashes"]
+		return []
 
-	def BuildDataBlockPacket(self, fname, block_list):
-		"""Builds a data block packet. Contains the file name and the list of blocks for the file"""
+	def BuildHaveResponse(self, chunks):
+		"""Builds the response to a have packet: for each hash already
+		stored, its chunk id, checksum, codec, stored size and the data
+		nodes that hold it."""
+		self.packet = {"chunks": chunks}
+
+	def getChunks(self):
+		"""Returns the chunks of a have response, by hash."""
+		if "chunks" in self.packet:
+			return self.packet["chunks"]
+		return {}
+
+	def BuildDataBlockPacket(self, fname, block_list, parity=None):
+		"""Builds a data block packet. Contains the file name and the list of blocks for the file,
+		and the parity blocks of an erasure coded file."""
 		self.BuildCommand("dblks")
 		self.packet["blocks"] = block_list
 		self.packet["fname"] = fname
+		if parity:
+			self.packet["parity"] = parity
 
 	def BuildGetDataBlockPacket(self, blockid):
 		"""Builds a get data block packet. Usefull when requesting a data block to a data node."""
 		self.BuildCommand("get")
 		self.packet["blockid"] = blockid
 
+	def BuildGetBlockPacket(self, fname, blockidx, blockid=None):
+		"""Builds a get packet for the blockidx-th block of fname, with its
+		block id when known."""
+		self.BuildGetPacket(fname)
+		self.packet["blockidx"] = blockidx
+		if blockid is not None:
+			self.packet["blockid"] = blockid
+
+	def setRange(self, offset, length):
+		"""Asks for length bytes of a block, or of a file, starting at offset
+		instead of the whole of it.  A length of None asks for the rest."""
+		self.packet["offset"] = offset
+		self.packet["length"] = length
+
+	def getRange(self):
+		"""Returns the (offset, length) asked of a block or file, length is
+		None when the rest of it is asked for."""
+		return self.packet.get("offset", 0), self.packet.get("length")
+
+	def getBlockIndex(self):
+		"""Returns the block index of a put or get block packet."""
+		if "blockidx" in self.packet:
+			return self.packet["blockidx"]
+		return None
+
+	def setBlockIndex(self, blockidx):
+		"""Sets the position of the block sent in a put packet."""
+		self.packet["blockidx"] = blockidx
+
+	def getBlockSize(self):
+		"""Returns the block size the file was split with."""
+		if "bsize" in self.packet:
+			return self.packet["bsize"]
+		return None
+
+	def BuildBlockIDResponse(self, blockid):
+		"""Builds the response of a data node with the ID of a block."""
+		self.packet = {"blockid": blockid}
+
+	def setBlockID(self, blockid):
+		"""Sets the id a block put must be saved with, used by data nodes
+		forwarding a block down a pipeline."""
+		self.packet["blockid"] = blockid
+
 	def getBlockID(self):
 		"""Returns a the block_id from a packet."""
-		return self.packet["blockid"]
+		if "blockid" in self.packet:
+			return self.packet["blockid"]
+		return None
+
+	def setChecksum(self, crc):
+		"""Sets the CRC-32 of the block sent in a put packet."""
+		self.packet["crc"] = crc
+
+	def getChecksum(self):
+		"""Returns the CRC-32 of the block of a put packet, None if
+		the sender did not compute it."""
+		if "crc" in self.packet:
+			return self.packet["crc"]
+		return None
 
 	def getFileInfo(self):
 		"""Returns the file info in a packet."""
@@ -104,15 +403,89 @@ class Packet:
 		if "fname" in self.packet:
 			return self.packet["fname"] 
 
-	def BuildGetResponse(self, metalist, fsize):
-		"""Builds a list of data node servers with the blocks of a file, and file size."""
-		self.packet["servers"] = metalist
+	def BuildGetResponse(self, blocks, fsize, bsize=None, stripes=None):
+		"""Builds the block map of a file, file size and the block size the file
+		was split with.  The block map lists, in file order, each block's index,
+		offset, length, chunk id, the (address, port) of the data nodes that
+		hold it, its CRC-32 (None if it is not known), the codec it is
+		compressed with (None if it is not) and its size as stored.
+		For an erasure coded file stripes is (k, m, {stripe: [data blocks,
+		parity blocks]}), with the stripes of the blocks, so any of them
+		can be rebuilt if its data node does not send it."""
+		self.packet.pop("command", None)
+		self.packet["blocks"] = blocks
 		self.packet["fsize"] = fsize
+		self.packet["bsize"] = bsize
+		if stripes:
+			self.packet["stripes"] = stripes
+
+	def getStripes(self):
+		"""Returns the (k, m, stripes) of a get response, None if the
+		file is not erasure coded."""
+		if "stripes" in self.packet:
+			return self.packet["stripes"]
+		return None
+
+	def BuildPutResponse(self, chains, parity=None):
+		"""Builds, for each block of a file, the chain of data node servers where
+		the block is stored.  The block is sent to the first one, which forwards it
+		down the chain.  For an erasure coded file, parity has the data node of
+		each parity block of each stripe."""
+		self.packet.pop("command", None)
+		self.packet["chains"] = chains
+		if parity is not None:
+			self.packet["parity"] = parity
+
+	def getParity(self):
+		"""Returns the parity blocks of a data block packet, or their data
+		nodes in a put response, None if the file is not erasure coded."""
+		if "parity" in self.packet:
+			return self.packet["parity"]
+		return None
+
+	def setErasure(self, k, m):
+		"""Asks for a file to be erasure coded in stripes of k data
+		blocks and m parity blocks, instead of replicated."""
+		self.packet["erasure"] = (k, m)
+
+	def getErasure(self):
+		"""Returns the (k, m) a put asks for, None to replicate.  Anything
+		else the packet has is returned as an empty tuple."""
+		if "erasure" in self.packet:
+			erasure = self.packet["erasure"]
+			return tuple(erasure) if isinstance(erasure, (tuple, list)) else ()
+		return None
+
+	def getChains(self):
+		"""Returns the chain of data nodes of each block of a put response"""
+		if "chains" in self.packet:
+			return self.packet["chains"]
+		return None
 
-	def BuildPutResponse(self, metalist):
-		"""Builds a list of data node servers where a file data blocks can be stored.
-		I.E. a list of available data servers."""
-		self.packet["servers"] = metalist
+	def setReplicas(self, replicas):
+		"""Sets how many copies of each block a put asks for."""
+		self.packet["replicas"] = replicas
+
+	def getReplicas(self):
+		"""Returns how many copies of each block a put asks for, None
+		to use the metadata server's default."""
+		if "replicas" in self.packet:
+			return self.packet["replicas"]
+		return None
+
+	def setPipeline(self, nodes):
+		"""Sets the data nodes a block put must be forwarded to, in order."""
+		self.packet["pipeline"] = nodes
+
+	def getPipeline(self):
+		"""Returns the data nodes a block put must be forwarded to."""
+		if "pipeline" in self.packet:
+			return self.packet["pipeline"]
+		return []
+
+	def setDataNodes(self, nodes):
+		"""Sets the data nodes that stored a block, in a data node response."""
+		self.packet["servers"] = nodes
 
 	def getDataNodes(self):
 		"""Returns a list of data servers"""
@@ -126,9 +499,246 @@ class Packet:
 			return self.packet["blocks"]
 		return None
 
+	def BuildStatsPacket(self):
+		"""Builds a stats packet, asking a server for its metrics."""
+		self.BuildCommand("stats")
+
+	def BuildStatsResponse(self, stats):
+		"""Builds the response of a stats packet: counters and latency
+		histograms, see metrics.py."""
+		self.packet = {"stats": stats}
+
+	def getStats(self):
+		"""Returns the metrics of a stats response."""
+		return self.packet.get("stats")
+
+	def BuildStatusResponse(self, status):
+		"""Builds a response with just a status: ACK, DUP or NAK"""
+		self.packet = {"status": status}
+
+	def getStatus(self):
+		"""Returns the status of a response, None if it has none"""
+		if "status" in self.packet:
+			return self.packet["status"]
+		return None
+
 	def BuildCommand(self, cmd):
 		"""Builds a packet type"""
 		if cmd in self.commands:
 			self.packet = {"command": cmd}
 
 
+
+
+class PacketReader:
+	"""Reads frames from a socket.  Data is received with recv_into in a
+	buffer that is reused for every frame of the connection."""
+
+	def __init__(self, sock, bufsize=65536):
+		self.sock = sock
+		self.buf = bytearray(bufsize)
+		self.view = memoryview(self.buf)
+		# Received bytes not consumed yet are buf[start:end]
+		self.start = 0
+		self.end = 0
+		# Payload bytes of the last frame not consumed yet
+		self.payload_left = 0
+		# Buffer for payloads read in chunks, made on first use
+		self.chunk = None
+		# Bytes received from the socket so far
+		self.received = 0
+
+	def _fill(self, n):
+		"""Makes sure at least n bytes are buffered.  Returns False if the
+		connection was closed before any byte arrived."""
+		if self.end - self.start >= n:
+			return True
+
+		# Move what is left to the front and grow the buffer if needed
+		left = self.end - self.start
+		if self.start:
+			self.view[:left] = self.view[self.start:self.end]
+			self.start, self.end = 0, left
+		if n > len(self.buf):
+			buf = bytearray(n)
+			buf[:left] = self.view[:left]
+			self.buf, self.view = buf, memoryview(buf)
+
+		while self.end < n:
+			r = self.sock.recv_into(self.view[self.end:])
+			if not r:
+				if self.end == 0:
+					return False
+				raise ConnectionError("Connection closed in the middle of a frame")
+			self.end += r
+			self.received += r
+		return True
+
+	def _take(self, n):
+		"""Returns a view of the next n buffered bytes and consumes them."""
+		data = self.view[self.start:self.start + n]
+		self.start += n
+		return data
+
+	def readPacket(self):
+		"""Reads the next frame and returns its packet, or None if the
+		connection was closed.  The payload is left to be read with
+		readPayloadInto or readPayloadChunks, any payload not read is
+		skipped."""
+		self.skipPayload()
+
+		if not self._fill(FRAME_HEADER.size):
+			return None
+		mtype, plen, payload_len = FRAME_HEADER.unpack(self._take(FRAME_HEADER.size))
+		if plen > MAX_PACKET:
+			raise ConnectionError("Packet of %d bytes, at most %d accepted" % (plen, MAX_PACKET))
+		if not self._fill(plen):
+			raise ConnectionError("Connection closed in the middle of a frame")
+
+		p = Packet()
+		p.DecodePacket(self._take(plen), mtype, payload_len)
+		self.payload_left = payload_len
+		return p
+
+	def readPayloadInto(self, view):
+		"""Reads the payload of the last frame into view, returns the
+		number of bytes read."""
+		view = memoryview(view).cast("B")
+		n = min(len(view), self.payload_left)
+
+		# Bytes already buffered first, then straight from the socket
+		got = min(n, self.end - self.start)
+		view[:got] = self._take(got)
+		while got < n:
+			r = self.sock.recv_into(view[got:n])
+			if not r:
+				raise ConnectionError("Connection closed in the middle of a frame")
+			got += r
+			self.received += r
+
+		self.payload_left -= n
+		return n
+
+	def readPayloadChunks(self, chunk_size=1024 * 1024):
+		"""Yields the payload of the last frame in views of at most
+		chunk_size bytes, received with recv_into into one buffer that
+		is reused for every chunk.  A view is only valid until the next
+		one is asked for, so the payload is never all in memory."""
+		got = min(self.payload_left, self.end - self.start)
+		if got:
+			self.payload_left -= got
+			yield self._take(got)
+
+		if self.payload_left and (self.chunk is None or len(self.chunk) < chunk_size):
+			self.chunk = memoryview(bytearray(chunk_size))
+
+		while self.payload_left:
+			n = min(self.payload_left, chunk_size)
+			got = 0
+			while got < n:
+				r = self.sock.recv_into(self.chunk[got:n])
+				if not r:
+					raise ConnectionError("Connection closed in the middle of a frame")
+				got += r
+				self.received += r
+			self.payload_left -= n
+			yield self.chunk[:n]
+
+	def skipPayload(self):
+		"""Discards what is left of the payload of the last frame."""
+		while self.payload_left:
+			n = min(self.payload_left, len(self.buf))
+			self._fill(n)
+			self._take(n)
+			self.payload_left -= n
+
+
+class Connection:
+	"""A connection to a server and the PacketReader of its responses,
+	kept open for many requests."""
+
+	def __init__(self, address):
+		self.address = tuple(address)
+		self.sock = socket.create_connection(self.address)
+		# Requests are small, they are sent right away
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.reader = PacketReader(self.sock)
+		self.requests = 0
+		self.idle_since = time.monotonic()
+
+	def close(self):
+		self.sock.close()
+
+
+class ConnectionPool:
+	"""Connections to the metadata server and data nodes, by (host, port).
+	A connection is given back to the pool once its response is read, and
+	taken again by the next request to the same server, so requests do not
+	pay a TCP handshake each.  Thread safe, each connection is used by one
+	thread at a time."""
+
+	def __init__(self, max_idle=16):
+		self.max_idle = max_idle
+		self.lock = threading.Lock()
+		self.idle = {}
+
+	def acquire(self, address):
+		"""Returns an idle connection to address, or a new one."""
+		address = tuple(address)
+		with self.lock:
+			conns = self.idle.get(address)
+			while conns:
+				conn = conns.pop()
+				if time.monotonic() - conn.idle_since < IDLE_TIMEOUT / 2:
+					return conn
+				conn.close()
+		return Connection(address)
+
+	def release(self, conn):
+		"""Gives a connection back once the whole response was read, it is
+		closed if the pool has enough idle connections to its server."""
+		if conn.reader.payload_left:
+			conn.close()
+			return
+		conn.idle_since = time.monotonic()
+		with self.lock:
+			conns = self.idle.setdefault(conn.address, [])
+			if len(conns) < self.max_idle:
+				conns.append(conn)
+				return
+		conn.close()
+
+	def exchange(self, address, packet, payload=b""):
+		"""Sends a request and reads the packet of its response.  Returns
+		the connection, to read the payload of the response from and then
+		release or close, and the response.  A kept connection the server
+		closed meanwhile is replaced by a new one."""
+		while True:
+			conn = self.acquire(address)
+			try:
+				packet.sendPacket(conn.sock, payload)
+				rp = conn.reader.readPacket()
+				if rp is None:
+					raise ConnectionError("Connection closed by %s:%d" % conn.address)
+			except OSError:
+				conn.close()
+				if conn.requests:
+					continue
+				raise
+			conn.requests += 1
+			return conn, rp
+
+	def request(self, address, packet, payload=b""):
+		"""Sends a request and returns the packet of its response, for
+		responses without a payload."""
+		conn, rp = self.exchange(address, packet, payload)
+		self.release(conn)
+		return rp
+
+	def close(self):
+		"""Closes the idle connections."""
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle.clear()
@@ -0,0 +1,382 @@
+###############################################################################
+#
+# Filename: bench.py
+#
+# Description:
+# 	Benchmark of the DFS on this machine.  It starts a fresh meta-data
+# 	server (with a database made by createdb.py) and data nodes on
+# 	loopback, all in a temporary directory, and times the workloads:
+#
+# 	files	one client putting and getting files of each size, one
+# 		file at a time
+# 	small	one client putting and getting many small files at once,
+# 		and listing them
+# 	clients	several clients putting and getting files at once
+#
+# 	For each one it reports MB/s, ops/s and the p50/p99 latency of an
+# 	operation, and the peak RSS of every process at the end, as JSON
+# 	so runs can be compared.  Files are random, so no block is stored
+# 	twice and the codecs do not shrink them.
+
+# -------------- How to Run ---------------
+# python3 bench.py
+# 4 data nodes, 1K to 1G files, 2000 small files, 8 clients, to run.json:
+# python3 bench.py 4 1K,1M,64M,1G 2000 8 run.json
+# Compare runs with any JSON tool, i.e.
+# jq '.workloads[] | {name, put: .put.mb_per_s, get: .get.mb_per_s}' run.json
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import DFScopy
+from ls import listFiles
+
+def usage():
+	print ("""Usage: python %s <data nodes, default=3> <file sizes, default=1K,1M,64M> <small files, default=1000> <clients, default=4> <output file, default=stdout> <meta-data mode: threaded|asyncio, default=threaded>""" % sys.argv[0] )
+	sys.exit(0)
+
+# Directory of the DFS programs
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Default workloads
+NODES = 3
+SIZES = "1K,1M,64M"
+SMALL_FILES = 1000
+CLIENTS = 4
+
+# Each file size is put and got until about TOTAL_BYTES are moved,
+# at least once and at most MAX_OPS times
+TOTAL_BYTES = 256 * 1024 * 1024
+MAX_OPS = 100
+
+# Size of the small files, and of the files of each client
+SMALL_SIZE = 4 * 1024
+CLIENT_SIZE = 4 * 1024 * 1024
+CLIENT_FILES = 8
+
+# Seconds the servers are given to start listening
+START_TIMEOUT = 10
+
+# freePort returns a loopback port nothing listens on
+def freePort():
+	with socket.socket() as s:
+		s.bind(("localhost", 0))
+		return s.getsockname()[1]
+
+# waitPort waits until something listens on port
+def waitPort(port, proc):
+	deadline = time.monotonic() + START_TIMEOUT
+	while time.monotonic() < deadline:
+		if proc.poll() is not None:
+			raise RuntimeError("%s exited with %d" % (proc.args[1], proc.returncode))
+		try:
+			socket.create_connection(("localhost", port), 0.5).close()
+			return
+		except OSError:
+			time.sleep(0.05)
+	raise RuntimeError("%s did not start" % proc.args[1])
+
+# peakRSS returns the peak resident set size of a running process
+# in KiB, None if it is not known
+def peakRSS(pid):
+	try:
+		with open("/proc/%d/status" % pid) as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return None
+
+# writeRandom writes a file of size random bytes, a MiB at a time
+def writeRandom(path, size):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "wb") as f:
+		while size > 0:
+			n = min(size, 1 << 20)
+			f.write(os.urandom(n))
+			size -= n
+
+# summary returns the rates and latency percentiles of ops that
+# moved nbytes in seconds, latencies in seconds
+def summary(latencies, nbytes, seconds, ops=None):
+	ops = len(latencies) if ops is None else ops
+	latencies = sorted(latencies)
+	def percentile(q):
+		if not latencies:
+			return None
+		return round(latencies[round(q * (len(latencies) - 1))] * 1000, 3)
+	return {
+		"ops": ops,
+		"bytes": nbytes,
+		"seconds": round(seconds, 4),
+		"ops_per_s": round(ops / seconds, 2) if seconds else None,
+		"mb_per_s": round(nbytes / seconds / 1e6, 2) if seconds else None,
+		"p50_ms": percentile(0.5),
+		"p99_ms": percentile(0.99),
+	}
+
+
+# A Cluster is a meta-data server and data nodes on loopback,
+# with their database and data in a temporary directory
+class Cluster:
+
+	def __init__(self, nodes=NODES, mode="threaded"):
+		self.nodes = nodes
+		self.mode = mode
+		self.procs = []
+
+	def start(self):
+		self.path = tempfile.mkdtemp(prefix="dfsbench.")
+		subprocess.run([sys.executable, os.path.join(HERE, "createdb.py")], cwd=self.path,
+			stdout=subprocess.DEVNULL, check=True)
+
+		self.meta_port = freePort()
+		self.meta = self.spawn(self.path, "meta-data.py", str(self.meta_port), self.mode)
+		waitPort(self.meta_port, self.meta)
+
+		# Data nodes register before they listen, once they listen
+		# the meta-data server hands out blocks to them
+		self.data_nodes = []
+		for i in range(self.nodes):
+			path = os.path.join(self.path, "dn%d" % i)
+			os.mkdir(path)
+			port = freePort()
+			proc = self.spawn(path, "data-node.py", "localhost", str(port), str(self.meta_port), path)
+			waitPort(port, proc)
+			self.data_nodes.append(proc)
+		return ("localhost", self.meta_port)
+
+	def spawn(self, cwd, script, *args):
+		proc = subprocess.Popen([sys.executable, os.path.join(HERE, script)] + list(args), cwd=cwd,
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		self.procs.append(proc)
+		return proc
+
+	def peakRSS(self):
+		return {
+			"meta": peakRSS(self.meta.pid),
+			"data_nodes": [peakRSS(proc.pid) for proc in self.data_nodes],
+		}
+
+	def stop(self):
+		for proc in self.procs:
+			proc.terminate()
+		for proc in self.procs:
+			try:
+				proc.wait(5)
+			except subprocess.TimeoutExpired:
+				proc.kill()
+				proc.wait()
+		shutil.rmtree(self.path, ignore_errors=True)
+
+
+# ---------------------- Workloads --------------
+
+# putGet puts the files one at a time, then gets them back one at a
+# time, timing each operation.  files are (local path, dfs path,
+# size).  Returns the put and get latencies.
+def putGet(address, files, out, bsize=DFScopy.BLOCK_SIZE):
+	puts, gets = [], []
+	for path, fname, size in files:
+		t = time.perf_counter()
+		if not DFScopy.copyManyToDFS(address, [(path, fname)], bsize):
+			raise RuntimeError("put %s failed" % fname)
+		puts.append(time.perf_counter() - t)
+
+	for path, fname, size in files:
+		dst = os.path.join(out, os.path.basename(path))
+		t = time.perf_counter()
+		if not DFScopy.copyManyFromDFS(address, [(fname, dst)]):
+			raise RuntimeError("get %s failed" % fname)
+		gets.append(time.perf_counter() - t)
+		os.remove(dst)
+	return puts, gets
+
+def benchSizes(address, path, sizes):
+	results = []
+	for size in sizes:
+		count = max(1, min(MAX_OPS, TOTAL_BYTES // size))
+		src = os.path.join(path, "src")
+		files = []
+		for i in range(count):
+			local = os.path.join(src, "f%d" % i)
+			writeRandom(local, size)
+			files.append( (local, "/files/%d/f%d" % (size, i), size) )
+
+		puts, gets = putGet(address, files, path)
+		shutil.rmtree(src)
+		nbytes = size * count
+		results.append({
+			"name": "files",
+			"file_size": size,
+			"files": count,
+			"put": summary(puts, nbytes, sum(puts)),
+			"get": summary(gets, nbytes, sum(gets)),
+		})
+		print(f"files of {size} bytes: put {results[-1]['put']['mb_per_s']} MB/s, get {results[-1]['get']['mb_per_s']} MB/s", file=sys.stderr)
+	return results
+
+def benchSmall(address, path, count):
+	src = os.path.join(path, "small")
+	paths = []
+	for i in range(count):
+		local = os.path.join(src, "s%06d" % i)
+		writeRandom(local, SMALL_SIZE)
+		paths.append( (local, "/small/s%06d" % i) )
+	nbytes = SMALL_SIZE * count
+
+	t = time.perf_counter()
+	copied = DFScopy.copyManyToDFS(address, paths)
+	put = time.perf_counter() - t
+
+	# Every page of the listing is an operation
+	pages, entries = [], 0
+	t = time.perf_counter()
+	last = t
+	for fname, fsize in listFiles(address, "/small/", pool=DFScopy.connections):
+		entries += 1
+		if entries % 1000 == 0:
+			now = time.perf_counter()
+			pages.append(now - last)
+			last = now
+	now = time.perf_counter()
+	if entries % 1000:
+		pages.append(now - last)
+	listing = now - t
+
+	out = os.path.join(path, "small.out")
+	os.makedirs(out)
+	t = time.perf_counter()
+	got = DFScopy.copyManyFromDFS(address, [(fname, os.path.join(out, os.path.basename(fname))) for local, fname in paths])
+	get = time.perf_counter() - t
+	shutil.rmtree(src)
+	shutil.rmtree(out)
+
+	if len(copied) != count or len(got) != count or entries != count:
+		raise RuntimeError("small files: put %d, listed %d, got %d of %d" % (len(copied), entries, len(got), count))
+
+	# The files are moved in batches, there is no latency per file
+	result = {
+		"name": "small",
+		"file_size": SMALL_SIZE,
+		"files": count,
+		"put": summary([], nbytes, put, count),
+		"get": summary([], nbytes, get, count),
+		"list": summary(pages, 0, listing, entries),
+	}
+	print(f"{count} small files: put {result['put']['ops_per_s']} files/s, get {result['get']['ops_per_s']} files/s, list {result['list']['ops_per_s']} files/s", file=sys.stderr)
+	return result
+
+# client is run by each client process of benchClients
+def client(address, path, n):
+	files = []
+	for i in range(CLIENT_FILES):
+		local = os.path.join(path, "c%d" % n, "f%d" % i)
+		writeRandom(local, CLIENT_SIZE)
+		files.append( (local, "/clients/c%d/f%d" % (n, i), CLIENT_SIZE) )
+	out = os.path.join(path, "c%d.out" % n)
+	os.makedirs(out)
+
+	start = time.perf_counter()
+	puts, gets = putGet(address, files, out)
+	elapsed = time.perf_counter() - start
+	shutil.rmtree(os.path.join(path, "c%d" % n))
+	shutil.rmtree(out)
+	return puts, gets, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchClients(address, path, clients):
+	# Clients are started fresh, not forked with the connections
+	# of this process
+	context = multiprocessing.get_context("spawn")
+	with ProcessPoolExecutor(max_workers=clients, mp_context=context) as pool:
+		start = time.perf_counter()
+		runs = list(pool.map(client, [address] * clients, [path] * clients, range(clients)))
+		elapsed = time.perf_counter() - start
+
+	puts = [latency for run in runs for latency in run[0]]
+	gets = [latency for run in runs for latency in run[1]]
+	nbytes = CLIENT_SIZE * CLIENT_FILES * clients
+
+	# Clients put and get at the same time as the others, the
+	# rates are of all of them over the time of the slowest
+	putTime = max(sum(run[0]) for run in runs)
+	getTime = max(sum(run[1]) for run in runs)
+	result = {
+		"name": "clients",
+		"file_size": CLIENT_SIZE,
+		"files": CLIENT_FILES * clients,
+		"clients": clients,
+		"seconds": round(elapsed, 4),
+		"put": summary(puts, nbytes, putTime),
+		"get": summary(gets, nbytes, getTime),
+		"client_peak_rss_kb": max(run[3] for run in runs),
+	}
+	print(f"{clients} clients: put {result['put']['mb_per_s']} MB/s, get {result['get']['mb_per_s']} MB/s", file=sys.stderr)
+	return result
+
+
+# run starts a cluster, runs every workload on it and returns
+# the results
+def run(nodes=NODES, sizes=None, small=SMALL_FILES, clients=CLIENTS, mode="threaded"):
+	sizes = sizes or [DFScopy.parseSize(size) for size in SIZES.split(",")]
+	cluster = Cluster(nodes, mode)
+	try:
+		address = cluster.start()
+		workloads = benchSizes(address, cluster.path, sizes)
+		if small:
+			workloads.append( benchSmall(address, cluster.path, small) )
+		if clients:
+			workloads.append( benchClients(address, cluster.path, clients) )
+		rss = cluster.peakRSS()
+	finally:
+		cluster.stop()
+
+	rss["client"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return {
+		"config": {
+			"nodes": nodes,
+			"mode": mode,
+			"block_size": DFScopy.BLOCK_SIZE,
+			"transfers": DFScopy.TRANSFERS,
+			"python": platform.python_version(),
+			"machine": platform.machine(),
+			"cpus": os.cpu_count(),
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		},
+		"workloads": workloads,
+		"peak_rss_kb": rss,
+	}
+
+
+if __name__ == "__main__":
+	try:
+		nodes = int(sys.argv[1]) if len(sys.argv) > 1 else NODES
+		sizes = [DFScopy.parseSize(size) for size in (sys.argv[2] if len(sys.argv) > 2 else SIZES).split(",")]
+		small = int(sys.argv[3]) if len(sys.argv) > 3 else SMALL_FILES
+		clients = int(sys.argv[4]) if len(sys.argv) > 4 else CLIENTS
+	except ValueError:
+		usage()
+	if nodes < 1 or small < 0 or clients < 0 or min(sizes) <= 0:
+		usage()
+
+	mode = sys.argv[6] if len(sys.argv) > 6 else "threaded"
+	if mode not in ("threaded", "asyncio"):
+		usage()
+
+	report = json.dumps(run(nodes, sizes, small, clients, mode), indent=2)
+	if len(sys.argv) > 5 and sys.argv[5] != "-":
+		with open(sys.argv[5], "w") as f:
+			f.write(report + "\n")
+	else:
+		print(report)
@@ -5,7 +5,7 @@ conn = sqlite3.connect("dfs.db")
 c = conn.cursor()
 
 # Create inode table 
-c.execute("""CREATE TABLE inode (fid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fname TEXT UNIQUE NOT NULL DEFAULT " ", fsize INTEGER NOT NULL default "0")""")
+c.execute("""CREATE TABLE inode (fid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fname TEXT UNIQUE NOT NULL DEFAULT " ", fsize INTEGER NOT NULL default "0", bsize INTEGER NOT NULL DEFAULT "0")""")
 
 # Create data node table
 c.execute("""CREATE TABLE dnode(nid INTEGER PRIMARY KEY ASC AUTOINCREMENT, address TEXT NOT NULL default " ", port INTEGER NOT NULL DEFAULT "0")""") 
@@ -18,3 +18,13 @@ c.execute("""CREATE TABLE block (bid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fid
 
 # Create UNIQUE tuple for block
 c.execute("""CREATE UNIQUE INDEX blocknc ON block(nid, cid)""") 
+
+conn.close()
+
+# Bring the new database up to the latest schema version
+from mds_db import *
+
+db = mds_db("dfs.db")
+db.Connect()
+print("Schema version %d" % db.Migrate())
+db.Close()
@@ -5,16 +5,24 @@
 # Description:
 # 	data node server for the DFS
 #
-#								 hostname  port  meta-data's port
+#								 hostname  port  meta-data's port  data path
 # Running:  python3 data-node.py localhost 1111  1234
+# Running:  python3 data-node.py localhost 1111  1234  /var/dfs/node1
 
 
 from Packet import *
+from metrics import Metrics
+import logs
 import sys
 import socket
 import socketserver
 import uuid
 import os
+import zlib
+import mmap
+import time
+import shutil
+import threading
 
 # Global Variables to help
 # Data Node identify itself
@@ -22,60 +30,306 @@ import os
 host_= ''
 port = ''
 
+# Directory where the blocks are saved, the current
+# directory unless given in the command line
+data_path = '.'
+
 
 def usage():
-	print ("""Usage: python %s <server> <port> <metadata port,default=8000>""" % sys.argv[0] )
+	print ("""Usage: python %s <server> <port> <metadata port,default=8000> <data path,default=.>""" % sys.argv[0] )
 	sys.exit(0)
 
+log = logs.getLogger("data-node")
+
+# Connections kept open to the metadata server, for the
+# heartbeats, and to the next data nodes of the pipelines
+connections = ConnectionPool()
+
 
 def register(meta_ip, meta_port, data_ip, data_port):
 	"""Creates a connection with the metadata server and
 	   register as data node
 	"""
 
-	# Establish connection
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	sock.connect((meta_ip, meta_port))
+	sp = Packet()
+
+	log.info("Registering with %s:%d", meta_ip, meta_port)
+
+	sp.BuildRegPacket(data_ip, data_port)
+	rp = connections.request((meta_ip, meta_port), sp)
+	response = rp.getStatus()
+
+	if response == "DUP":
+		log.info("Duplicate Registration")
+
+	if response == "NAK":
+		log.error("Registration ERROR")
+
+
+# Seconds between the heartbeats sent to the metadata server
+HEARTBEAT_INTERVAL = 3
+
+def heartbeat(meta_ip, meta_port, data_ip, data_port):
+	"""Sends the metadata server a heartbeat every HEARTBEAT_INTERVAL
+	   seconds with the free space, number of blocks and transfers in
+	   flight of this node.  If the metadata server does not know the
+	   node anymore it registers again.
+	"""
+	while True:
+		time.sleep(HEARTBEAT_INTERVAL)
 
-	try:
-		response = "NAK"
 		sp = Packet()
-		while response == "NAK":
+		sp.BuildHeartbeatPacket(data_ip, data_port, shutil.disk_usage(data_path).free,
+			len(block_index.blocks), transfers.value)
 
-			print("Registering")
+		try:
+			rp = connections.request((meta_ip, meta_port), sp)
+		except OSError as e:
+			log.warning("Heartbeat failed: %s", e)
+			continue
 
-			sp.BuildRegPacket(data_ip, data_port)
-			sock.sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-			response = sock.recv(1024)
+		if rp.getStatus() == "NAK":
+			try:
+				register(meta_ip, meta_port, data_ip, data_port)
+			except OSError as e:
+				log.warning("Registration failed: %s", e)
 
-			print(response.decode())
 
-			if response.decode() == "DUP":
-				print ("Duplicate Registration")
+class Counter:
+	"""Thread safe counter, i.e. of the transfers in flight"""
 
-			if response.decode() == "NAK":
-				print ("Registration ERROR")
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.value = 0
 
-	finally:
-		sock.close()
+	def add(self, n):
+		with self.lock:
+			self.value += n
+
+transfers = Counter()
+
+# Counters and latencies answered to stats requests
+metrics = Metrics()
 
 
 def clean_path(filename):
 	str = filename.split('/')
 	return str[-1]
 
+# Block files are named after the block's position in the
+# file followed by the block ID.  Copies of blocks made by
+# other nodes are also marked with this node's address, so
+# nodes sharing a data path can tell their blocks apart.
+def blockFileName(blockidx, blockid, node_addr):
+	name = "%08d_%s" % (blockidx, blockid)
+	if not blockid.endswith(":" + node_addr):
+		name += "@" + node_addr
+	return name
+
+# Returns the block ID of a block file of this node, None
+# if the file is not a block of this node
+def blockIDFromFileName(name, node_addr):
+	if "_" not in name:
+		return None
+	blockid = name.split("_", 1)[1]
+	if blockid.endswith("@" + node_addr):
+		return blockid[:-len("@" + node_addr)]
+	if blockid.endswith(":" + node_addr):
+		return blockid
+	return None
+
+
+# Blocks are sent from disk to the socket with sendfile, without
+# copying them to user space.  Where sendfile is not available they
+# are sent in chunks read into one reusable buffer.
+SEND_CHUNK = 1024 * 1024
+
+def sendRange(sock, f, offset, count):
+	if hasattr(os, "sendfile"):
+		sock.sendfile(f, offset, count)
+		return
+
+	buf = bytearray(min(count, SEND_CHUNK))
+	view = memoryview(buf)
+	f.seek(offset)
+	while count:
+		n = f.readinto(view[:min(count, len(buf))])
+		if not n:
+			raise IOError("Block file is shorter than expected")
+		sock.sendall(view[:n])
+		count -= n
+
+# sendVerified sends a whole block checking its CRC-32 as it goes.
+# The block is read through mmap, so it is not copied to Python
+# objects, and the last chunk is only sent if the checksum matches:
+# a corrupt block never reaches the client whole.  Returns False if
+# the block is corrupt.
+def sendVerified(sock, f, length, crc):
+	if not length:
+		return crc == 0
+	if os.fstat(f.fileno()).st_size != length:
+		return False
+
+	with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) as mm:
+		view = memoryview(mm)
+		try:
+			check = 0
+			for offset in range(0, length, SEND_CHUNK):
+				with view[offset:offset + SEND_CHUNK] as chunk:
+					check = zlib.crc32(chunk, check)
+					if offset + len(chunk) == length and check != crc:
+						return False
+					sock.sendall(chunk)
+			return True
+		finally:
+			view.release()
+
+# Saves the checksum of a block next to it, in <block>.crc
+CRC_SUFFIX = ".crc"
+
+def writeChecksum(path, crc):
+	with open(path + CRC_SUFFIX, 'w') as f:
+		f.write("%08x" % crc)
+
+def readChecksum(path):
+	try:
+		with open(path + CRC_SUFFIX) as f:
+			return int(f.read(), 16)
+	except (OSError, ValueError):
+		return None
+
+
+# Blocks are received in chunks of RECV_CHUNK bytes into a reusable
+# buffer and written to a temporary file, renamed once complete
+RECV_CHUNK = 4 * 1024 * 1024
+TEMP_SUFFIX = ".tmp"
+CORRUPT_SUFFIX = ".corrupt"
+
+
+class BlockIndex:
+	"""In memory index of the blocks saved by this data node, from
+	block ID to the path of the block file, its length and checksum.
+	It is loaded from the data path at startup and updated on every
+	put, so a get never has to list directories.  It also keeps when
+	each block was last verified, for the scrubber."""
+
+	def __init__(self):
+		self.blocks = {}
+		self.verified = {}
+
+	def load(self, path, node_addr):
+		"""Indexes the block files of this node found in path, one
+		directory per file.  Returns the number of blocks."""
+		for entry in os.scandir(path):
+			if not entry.is_dir():
+				continue
+			for block in os.scandir(entry.path):
+				name = block.name
+				temp = name.endswith(TEMP_SUFFIX)
+				if temp:
+					name = name[:-len(TEMP_SUFFIX)]
+				blockid = blockIDFromFileName(name, node_addr)
+				if blockid is None:
+					continue
+				# Blocks that were still arriving when the node stopped
+				if temp:
+					os.remove(block.path)
+					continue
+				self.add(blockid, block.path, block.stat().st_size, readChecksum(block.path), 0)
+		return len(self.blocks)
+
+	def add(self, blockid, path, length, crc, verified=None):
+		self.blocks[blockid] = (path, length, crc)
+		self.verified[blockid] = time.time() if verified is None else verified
+
+	def get(self, blockid):
+		"""Returns the (path, length, crc) of a block, None if this node
+		does not have it."""
+		return self.blocks.get(blockid)
+
+	def setVerified(self, blockid):
+		if blockid in self.blocks:
+			self.verified[blockid] = time.time()
+
+	def cold(self, age):
+		"""Returns the blocks with a checksum that were not verified in
+		the last age seconds, least recently verified first."""
+		since = time.time() - age
+		cold = []
+		for blockid, verified in list(self.verified.items()):
+			block = self.blocks.get(blockid)
+			if verified < since and block is not None and block[2] is not None:
+				cold.append(blockid)
+		return sorted(cold, key=lambda b: self.verified.get(b, 0))
+
+	def setCorrupt(self, blockid):
+		"""Takes a corrupt block out of the index, its file is kept
+		renamed as <block>.corrupt"""
+		block = self.blocks.pop(blockid, None)
+		self.verified.pop(blockid, None)
+		if block is not None:
+			log.error("Block %s is corrupt", blockid)
+			metrics.add("blocks_corrupt")
+			try:
+				os.replace(block[0], block[0] + CORRUPT_SUFFIX)
+			except OSError:
+				pass
+
+block_index = BlockIndex()
+
+
+# The scrubber reads back the blocks not verified in the last
+# SCRUB_AGE seconds, every SCRUB_INTERVAL seconds, to find the ones
+# that rotted on disk before a client asks for them.  It reads at
+# most SCRUB_RATE bytes per second and waits while there are
+# transfers in flight, so it does not slow clients down.
+SCRUB_INTERVAL = 60
+SCRUB_AGE = 24 * 60 * 60
+SCRUB_RATE = 8 * 1024 * 1024
+
+def scrubber():
+	buf = bytearray(SEND_CHUNK)
+	view = memoryview(buf)
+	while True:
+		time.sleep(SCRUB_INTERVAL)
+		for blockid in block_index.cold(SCRUB_AGE):
+			block = block_index.get(blockid)
+			if block is None:
+				continue
+			path, length, crc = block
+
+			check = 0
+			try:
+				with open(path, 'rb', buffering=0) as f:
+					while True:
+						while transfers.value > 0:
+							time.sleep(1)
+						n = f.readinto(view)
+						if not n:
+							break
+						check = zlib.crc32(view[:n], check)
+						time.sleep(n / SCRUB_RATE)
+			except OSError as e:
+				log.warning("Scrub of block %s failed: %s", blockid, e)
+				continue
+
+			metrics.add("blocks_scrubbed")
+			if check == crc:
+				block_index.setVerified(blockid)
+			else:
+				block_index.setCorrupt(blockid)
+
 class DataNodeTCPHandler(socketserver.BaseRequestHandler):
 
-	def handle_put(self, p):
+	def handle_put(self, p, reader):
 		"""Receives a block of data from a copy client, and 
 		   saves it with an unique ID.  The ID is sent back to the
-		   copy client.
+		   copy client.  Returns the number of bytes sent.
 		"""
-		print("Data Node, handle_put")
-
 		# name, size
 		# fname, fsize, content = p.getPutFileInfo()
 		fname, fsize = p.getFileInfo()
+		blockidx = p.getBlockIndex() or 0
 
 
 		global host_addr
@@ -84,106 +338,273 @@ class DataNodeTCPHandler(socketserver.BaseRequestHandler):
 		# We'll be creating a folder with that name
 		# it'll contain file's who's name are the block id's
 		# print(f"fname: {fname} , fsize: {fsize}, \ncontent: {content}")
-		print(f"fname: {fname} \t fsize: {fsize}")
-
-		# Generating unique block ID
-		blockid = str(uuid.uuid1())
-		blockid += ":" + host_addr + port_num
 
-		# Sending the block ID
-		self.request.sendall(bytes(blockid, 'UTF-8'))
+		# Generating unique block ID, unless the block comes
+		# from the previous node of a pipeline that named it
+		blockid = p.getBlockID()
+		if blockid is None:
+			blockid = str(uuid.uuid1())
+			blockid += ":" + host_addr + port_num
 
-		content = self.request.recv(1024)
-		print(f"\nContent's len: {len(content)}\n fsize: {fsize}\n")
+		# The next node of the pipeline gets the block
+		# while this node is still receiving it
+		downstream = self.openPipeline(p, blockid)
 
-		while(len(content) < fsize):
-			content += self.request.recv(1024)
-			print(f"\nWriting... {len(content)}\n")
 
-
-		print("Writing done...")
-		# print(f"\nContent Received: {content}\n")
-
-		print(f"blockid: {blockid}")
-
-
-		print("Cleaning Path...")
 		fname = clean_path(fname)
-		dir_name = fname
-
-		print(f"Directory Name to make: {dir_name}")
+		dir_name = os.path.join(data_path, fname)
 
 		if not os.path.exists( dir_name ):
 
-			print("making...")
-			os.makedirs( dir_name )
+			# Blocks of the same file may arrive at once
+			os.makedirs( dir_name, exist_ok=True )
 
 		# else:
 		# 	print("It already exists goober!")
 
 		# Now we'll create files
 		# containing the content
-		# IDs: the blockid's in order
-		write_to_file_path = dir_name + "/" + blockid
-		print(f"\nWrite to file: {write_to_file_path}")
-
-		# Writes with wb
-		write_to_file = open(write_to_file_path, 'wb')
-		write_to_file.write(content)
-		write_to_file.close()
-
-		print("\nFinished Writing To\n")
-
-
-
-	def handle_get(self, p):
-		
-		print("Data Node, handle_get")
+		# Names: the block index followed by the blockid
+		write_to_file_path = os.path.join(dir_name, blockFileName(blockidx, blockid, host_addr + port_num))
+		log.debug("Put block %d of %s (%d bytes) to %s", blockidx, fname, fsize, write_to_file_path)
+
+		# The block is the payload of the put packet, it is
+		# written as it arrives to a temporary file that only
+		# takes the block's name once the whole block is saved.
+		# The checksum is computed as the block arrives, a block
+		# that does not match the client's is not saved.
+		temp_path = write_to_file_path + TEMP_SUFFIX
+		expected = p.getChecksum()
+		length = 0
+		crc = 0
+		disk = 0.0
+		try:
+			with open(temp_path, 'wb', buffering=0) as write_to_file:
+				for chunk in reader.readPayloadChunks(RECV_CHUNK):
+					start = time.perf_counter()
+					write_to_file.write(chunk)
+					disk += time.perf_counter() - start
+					length += len(chunk)
+					crc = zlib.crc32(chunk, crc)
+					downstream = self.forward(downstream, chunk)
+			if expected is not None and crc != expected:
+				log.warning("Block %s: checksum %08x, expected %08x", blockid, crc, expected)
+				os.remove(temp_path)
+				if downstream is not None:
+					downstream.close()
+				metrics.add("checksum_errors")
+				sp = Packet()
+				sp.BuildStatusResponse("NAK")
+				return sp.sendPacket(self.request)
+			start = time.perf_counter()
+			writeChecksum(write_to_file_path, crc)
+			os.replace(temp_path, write_to_file_path)
+			metrics.observe("disk.write", disk + time.perf_counter() - start)
+		except:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+			if downstream is not None:
+				downstream.close()
+			raise
+
+		block_index.add(blockid, write_to_file_path, length, crc)
+		if downstream is not None:
+			metrics.add("pipeline_bytes_out", length)
+
+		# Sending the block ID once the block is saved, with
+		# this node and the ones down the pipeline that saved it
+		sp = Packet()
+		sp.BuildBlockIDResponse(blockid)
+		sp.setDataNodes([(host_addr, int(port_num))] + self.closePipeline(downstream))
+		sent = sp.sendPacket(self.request)
 
-		# Get the block id from the packet
-		fname = p.getFileName()
-		print(f"fname: {fname}")
+		log.debug("Saved block %s, %d bytes", blockid, length)
+		return sent
 
-		blockIDs = os.listdir(fname)
-		sorted_IDs = sorted(blockIDs)
-		print(sorted_IDs)
 
-		# print(f"Who am I? {host_addr} {port_num}")
+	def openPipeline(self, p, blockid):
+		"""Sends the put to the next node of the pipeline, if any.
+		   Returns the connection to it, None if there is no next
+		   node or it can not be reached."""
+		pipeline = p.getPipeline()
+		if not pipeline:
+			return None
 
-		node_addr = host_addr + '' + port_num
-		node_inode = ''
-		for i in sorted_IDs:
-			if node_addr in i:
-				node_inode = i
+		fname, fsize = p.getFileInfo()
+		sp = Packet()
+		sp.BuildPutPacket(fname, fsize)
+		sp.setBlockIndex(p.getBlockIndex() or 0)
+		sp.setBlockID(blockid)
+		sp.setPipeline(pipeline[1:])
+		if p.getChecksum() is not None:
+			sp.setChecksum(p.getChecksum())
+
+		try:
+			conn = connections.acquire(pipeline[0])
+		except OSError as e:
+			log.warning("Pipeline to %s failed: %s", pipeline[0], e)
+			return None
+		try:
+			sp.sendHeader(conn.sock, p.getPayloadSize())
+		except OSError as e:
+			# A kept connection may have been closed by the
+			# next node, the block is sent in a new one
+			conn.close()
+			if not conn.requests:
+				log.warning("Pipeline to %s failed: %s", pipeline[0], e)
+				return None
+			return self.openPipeline(p, blockid)
+		return conn
+
+	def forward(self, downstream, chunk):
+		"""Forwards a chunk of the block down the pipeline.  Returns
+		   the connection, None once the next node failed, the block
+		   is still saved here."""
+		if downstream is None:
+			return None
+		try:
+			downstream.sock.sendall(chunk)
+			return downstream
+		except OSError as e:
+			log.warning("Pipeline failed: %s", e)
+			downstream.close()
+			return None
+
+	def closePipeline(self, downstream):
+		"""Waits for the next node of the pipeline to save the block,
+		   returns the nodes down the pipeline that saved it."""
+		if downstream is None:
+			return []
+		try:
+			rp = downstream.reader.readPacket()
+		except OSError as e:
+			log.warning("Pipeline failed: %s", e)
+			downstream.close()
+			return []
+		if rp is None:
+			downstream.close()
+			return []
+		downstream.requests += 1
+		connections.release(downstream)
+		if rp.getStatus() == "NAK":
+			return []
+		return rp.getDataNodes() or []
 
 
-		print(f"This is my inode {node_inode}")
 
-		# Reads with rb
-		with open(os.path.join(fname, node_inode), 'rb') as f:
-			data = f.read()
-			print(f"\n\nData Read: {data}")
-			self.request.sendall(data)
+	def handle_get(self, p):
+		"""Sends a block, or a range of it, to a copy client.
+		   Returns the number of bytes sent.
+		"""
 
+		# Get the block id from the packet
+		blockid = p.getBlockID()
 
-		print("\nFinished getting\n")
+		sp = Packet()
+		block = block_index.get(blockid)
+		if block is None:
+			sp.BuildStatusResponse("NAK")
+			return sp.sendPacket(self.request)
+
+		path, length, crc = block
+
+		# Only the asked range of the block is sent,
+		# the whole block unless the packet says otherwise
+		offset, count = p.getRange()
+		offset = min(max(offset, 0), length)
+		if count is None or offset + count > length:
+			count = length - offset
+
+		# Reads with rb, the range is sent as the payload
+		# straight from the file.  Whole blocks are checked
+		# against their checksum while they are sent.
+		# The disk reads and the sends are one and the same
+		# (sendfile), they are timed together.
+		with open(path, 'rb') as f:
+			log.debug("Get block %s: %d bytes at %d", blockid, count, offset)
+			sp.BuildBlockIDResponse(blockid)
+			sent = sp.sendHeader(self.request, count)
+			# An empty range has nothing to send,
+			# sendfile does not take a count of 0
+			if not count:
+				return sent
+			with metrics.timer("disk.send"):
+				if crc is None or offset or count != length:
+					sendRange(self.request, f, offset, count)
+				elif sendVerified(self.request, f, length, crc):
+					block_index.setVerified(blockid)
+				else:
+					# The client gets a cut frame and
+					# asks another copy of the block, the
+					# connection can not be used anymore
+					block_index.setCorrupt(blockid)
+					self.request.shutdown(socket.SHUT_RDWR)
+					return sent
+
+		return sent + count
 
 
 	def handle(self):
-		msg = self.request.recv(1024)
-		print("handle -- data-note.py")
-		print (msg, type(msg))
-
-		p = Packet()
-		p.DecodePacket(msg)
+		# Clients keep the connection open for more blocks,
+		# until they close it or it is idle for too long
+		self.request.settimeout(IDLE_TIMEOUT)
+		# Responses sent in several writes are not held back
+		# waiting for the acknowledgement of the first one
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		reader = PacketReader(self.request)
+		metrics.add("connections")
+		metrics.add("connections_total")
+		try:
+			while True:
+				received = reader.received
+				try:
+					p = reader.readPacket()
+				except OSError:
+					return
+				if p is None:
+					return
+				log.debug("Request %s", p.packet)
+
+				# Latency is from the request received to the
+				# response sent, the payload of a put included
+				start = time.perf_counter()
+				cmd = p.getCommand()
+				if cmd == "stats":
+					stats = metrics.snapshot()
+					stats["blocks"] = len(block_index.blocks)
+					stats["inflight"] = transfers.value
+					stats["log_dropped"] = logs.dropped()
+					sp = Packet()
+					sp.BuildStatsResponse(stats)
+					sent = sp.sendPacket(self.request)
+
+				else:
+					# Transfers in flight are reported in the heartbeats
+					transfers.add(1)
+					try:
+						if cmd == "put":
+							sent = self.handle_put(p, reader)
+
+						elif cmd == "get":
+							sent = self.handle_get(p)
+
+						else:
+							return
+					finally:
+						transfers.add(-1)
+
+				metrics.request(cmd, time.perf_counter() - start, reader.received - received, sent)
+		finally:
+			metrics.add("connections", -1)
+		
 
-		cmd = p.getCommand()
-		if cmd == "put":
-			self.handle_put(p)
+# Clients keep several block transfers in flight,
+# each connection is served in its own thread.
+# The port can be reused right away after a restart.
+class DataNodeServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
 
-		elif cmd == "get":
-			self.handle_get(p)
-		
 
 if __name__ == "__main__":
 
@@ -205,16 +626,28 @@ if __name__ == "__main__":
 
 	if len(sys.argv) > 3:
 		META_PORT = int(sys.argv[3])
-		print(f"META_PORT {META_PORT}")
 
-	# if not os.path.isdir(DATA_PATH):
-	# 	print ("Error: Data path %s is not a directory." % DATA_PATH)
-	# 	usage()
-	# except:
-		# usage()
+	if len(sys.argv) > 4:
+		data_path = sys.argv[4]
+
+	if not os.path.isdir(data_path):
+		print ("Error: Data path %s is not a directory." % data_path)
+		usage()
+
+	logs.setup()
+
+	# Index the blocks saved before a restart
+	log.info("Blocks indexed: %d", block_index.load(data_path, host_addr + port_num))
 
 	register("localhost", META_PORT, HOST, PORT)
-	server = socketserver.TCPServer((HOST, PORT), DataNodeTCPHandler)
+
+	# Keep telling the metadata server this node is alive
+	threading.Thread(target=heartbeat, args=("localhost", META_PORT, HOST, PORT), daemon=True).start()
+
+	# Look for blocks that rotted on disk
+	threading.Thread(target=scrubber, daemon=True).start()
+
+	server = DataNodeServer((HOST, PORT), DataNodeTCPHandler)
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
@@ -0,0 +1,177 @@
+###############################################################################
+#
+# Filename: erasure.py
+#
+# Description:
+# 	Erasure coding support library for the DFS project.  The blocks of a
+# 	file are grouped in stripes of k data blocks, and m parity blocks are
+# 	computed for each stripe so that any k of its k + m blocks give back
+# 	the data blocks: up to m data nodes of a stripe can be lost.
+#
+# 	With m = 1 the parity block is the XOR of the data blocks.  With more
+# 	parity blocks they are Reed-Solomon codes over GF(2^8), with a Cauchy
+# 	matrix: parity block j is the sum of C[j][i] * data block i.
+#
+# 	Blocks of a stripe may be shorter than the parity blocks (the last
+# 	block of a file), they count as padded with zeros.
+#
+# 	The byte arithmetic is done a whole block at a time, in C: products
+# 	by a constant with bytes.translate (faster than a numpy table lookup),
+# 	sums with numpy XOR if numpy is installed, else with XOR of big
+# 	integers.
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1, generator 2
+POLYNOMIAL = 0x11d
+
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+	EXP[_i] = _x
+	LOG[_x] = _i
+	_x <<= 1
+	if _x & 0x100:
+		_x ^= POLYNOMIAL
+for _i in range(255, 512):
+	EXP[_i] = EXP[_i - 255]
+
+def mul(a, b):
+	if a == 0 or b == 0:
+		return 0
+	return EXP[LOG[a] + LOG[b]]
+
+def inv(a):
+	if a == 0:
+		raise ZeroDivisionError("0 has no inverse in GF(2^8)")
+	return EXP[255 - LOG[a]]
+
+# MUL[c] maps every byte to the byte times c, as a bytes.translate table
+MUL = [bytes(mul(c, x) for x in range(256)) for c in range(256)]
+
+# Most blocks a stripe can have
+MAX_BLOCKS = 256
+
+
+def parityRows(k, m):
+	"""Returns the coefficients of the m parity blocks of a stripe of k
+	data blocks: all ones (XOR) when m is 1, a Cauchy matrix otherwise."""
+	if k < 1 or m < 1 or k + m > MAX_BLOCKS:
+		raise ValueError("Stripes of %d+%d blocks are not supported" % (k, m))
+	if m == 1:
+		return [[1] * k]
+	return [[inv((k + j) ^ i) for i in range(k)] for j in range(m)]
+
+def generatorRow(k, m, piece, rows=None):
+	"""Returns the coefficients of block piece of a stripe: data blocks
+	are 0 to k - 1, parity blocks k to k + m - 1."""
+	if piece < k:
+		return [int(i == piece) for i in range(k)]
+	return (rows or parityRows(k, m))[piece - k]
+
+def invert(matrix):
+	"""Inverts a square matrix over GF(2^8) (Gauss-Jordan)."""
+	n = len(matrix)
+	a = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+	for col in range(n):
+		pivot = next((r for r in range(col, n) if a[r][col]), None)
+		if pivot is None:
+			raise ValueError("Singular matrix")
+		a[col], a[pivot] = a[pivot], a[col]
+		scale = inv(a[col][col])
+		a[col] = [mul(scale, x) for x in a[col]]
+		for r in range(n):
+			if r != col and a[r][col]:
+				factor = a[r][col]
+				a[r] = [x ^ mul(factor, y) for x, y in zip(a[r], a[col])]
+	return [row[n:] for row in a]
+
+
+# An accumulator holds a sum of blocks times coefficients: a numpy
+# array, or an integer with the bytes of the block in little endian
+# order, so shorter blocks are padded with zeros for free.
+
+def _zeros(size):
+	if numpy is not None:
+		return numpy.zeros(size, dtype=numpy.uint8)
+	return 0
+
+def _accumulate(acc, c, data):
+	"""Returns acc plus c times data."""
+	if not c or not len(data):
+		return acc
+	if c != 1:
+		data = bytes(data).translate(MUL[c])
+	if numpy is not None:
+		acc[:len(data)] ^= numpy.frombuffer(data, dtype=numpy.uint8)
+		return acc
+	return acc ^ int.from_bytes(data, "little")
+
+def _bytes(acc, size):
+	if numpy is not None:
+		return acc.tobytes()
+	return acc.to_bytes(size, "little")
+
+
+class Encoder:
+	"""Computes the parity blocks of a stripe of k data blocks of at most
+	size bytes, one data block at a time, so the data blocks need not be
+	kept until the stripe is complete."""
+
+	def __init__(self, k, m, size):
+		self.k = k
+		self.m = m
+		self.size = size
+		self.rows = parityRows(k, m)
+		self.acc = [_zeros(size) for j in range(m)]
+
+	def add(self, i, data):
+		"""Adds data block i of the stripe."""
+		if len(data) > self.size:
+			raise ValueError("Block of %d bytes in a stripe of %d" % (len(data), self.size))
+		for j in range(self.m):
+			self.acc[j] = _accumulate(self.acc[j], self.rows[j][i], data)
+
+	def parity(self):
+		"""Returns the m parity blocks, size bytes each.  Data blocks never
+		added count as zeros."""
+		return [_bytes(acc, self.size) for acc in self.acc]
+
+
+def encode(blocks, k, m, size):
+	"""Returns the m parity blocks of a stripe of data blocks."""
+	encoder = Encoder(k, m, size)
+	for i, block in enumerate(blocks):
+		encoder.add(i, block)
+	return encoder.parity()
+
+def decode(pieces, k, m, size, wanted):
+	"""Returns the data blocks wanted (their positions in the stripe),
+	size bytes each, from any k of the blocks of the stripe.  pieces maps
+	the position of each block available, data blocks 0 to k - 1 and
+	parity blocks k to k + m - 1, to its bytes."""
+	missing = [i for i in wanted if i not in pieces]
+	if not missing:
+		return [bytes(pieces[i]).ljust(size, b"\0") for i in wanted]
+
+	# Data blocks first, they need no arithmetic
+	chosen = sorted(pieces)[:k]
+	if len(chosen) < k:
+		raise ValueError("%d blocks of a stripe of %d+%d left, %d needed" % (len(pieces), k, m, k))
+	rows = parityRows(k, m)
+	decoding = invert([generatorRow(k, m, piece, rows) for piece in chosen])
+
+	blocks = []
+	for i in wanted:
+		if i in pieces:
+			blocks.append(bytes(pieces[i]).ljust(size, b"\0"))
+			continue
+		acc = _zeros(size)
+		for c, piece in zip(decoding[i], chosen):
+			acc = _accumulate(acc, c, pieces[piece])
+		blocks.append(_bytes(acc, size))
+	return blocks
@@ -0,0 +1,154 @@
+###############################################################################
+#
+# Filename: logs.py
+#
+# Description:
+# 	Logging support library for the DFS project.  Every module logs to
+# 	its own logger under "dfs" (getLogger), with levels and lazy
+# 	formatting: log.debug("block %s", blockid) costs a level check
+# 	when debug is off.
+#
+# 	Programs call setup() once.  Records are then put in a queue and
+# 	formatted and written by a thread of their own, so a slow terminal
+# 	or log pipe never holds back a transfer: when the queue is full
+# 	records are dropped, not waited for.  A message logged over and
+# 	over (the same format string) is kept to RATE_BURST records every
+# 	RATE_PERIOD seconds, and the next one says how many were dropped.
+#
+# 	The level is DFS_LOG in the environment (debug, info, warning,
+# 	error), info by default or if it is not one of them.  Sending a
+# 	program SIGUSR1 switches debug on and off while it runs:
+# 		kill -USR1 <pid>
+
+import os
+import sys
+import time
+import queue
+import atexit
+import signal
+import logging
+import threading
+import logging.handlers
+
+# Level of the dfs loggers unless setup is given one
+LEVEL = os.environ.get("DFS_LOG", "info").upper()
+
+# Records of the same message allowed every RATE_PERIOD seconds
+RATE_BURST = 10
+RATE_PERIOD = 1.0
+
+# Records waiting to be written, the ones logged when it is full are dropped
+QUEUE_SIZE = 10000
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def getLogger(name):
+	"""Returns the logger of a module of the DFS."""
+	return logging.getLogger("dfs." + name)
+
+
+class RateLimit(logging.Filter):
+	"""Lets through at most burst records of each message and level every
+	period seconds, so a flood of warnings never hides an error.  The
+	first record let through after some were dropped says how many."""
+
+	def __init__(self, burst=RATE_BURST, period=RATE_PERIOD):
+		super().__init__()
+		self.burst = burst
+		self.period = period
+		self.lock = threading.Lock()
+		# (logger, level, message): [window start, records, dropped]
+		self.windows = {}
+
+	def filter(self, record):
+		key = (record.name, record.levelno, record.msg)
+		now = time.monotonic()
+		with self.lock:
+			window = self.windows.get(key)
+			if window is None or now - window[0] >= self.period:
+				dropped = window[2] if window else 0
+				self.windows[key] = [now, 1, 0]
+			elif window[1] < self.burst:
+				window[1] += 1
+				return True
+			else:
+				window[2] += 1
+				return False
+		if dropped:
+			record.msg = str(record.msg) + " [%d similar dropped]" % dropped
+		return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+	"""Puts records in a bounded queue, the thread that writes them does
+	the formatting.  Only the message is merged with its arguments first,
+	they may be objects the caller changes right after, i.e. the packet
+	of a request that becomes the response.  Records that do not fit are
+	dropped and counted."""
+
+	def __init__(self, records):
+		super().__init__(records)
+		self.dropped = 0
+
+	def prepare(self, record):
+		record.msg = record.getMessage()
+		record.args = None
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+_handler = None
+_level = None
+
+def setup(level=None, stream=None):
+	"""Sends the records of the dfs loggers to stream (stderr by default)
+	through the queue and its writer thread, at level (LEVEL by
+	default), a name in any case.  An unknown level is taken as info,
+	with a warning.  SIGUSR1 switches debug on and off."""
+	global _handler, _level
+	if _handler is not None:
+		return
+
+	records = queue.Queue(QUEUE_SIZE)
+	_handler = QueueHandler(records)
+	_handler.addFilter(RateLimit())
+
+	_level = (level or LEVEL).upper()
+	unknown = None
+	if not isinstance(logging.getLevelName(_level), int):
+		unknown, _level = _level, "INFO"
+	root = logging.getLogger("dfs")
+	root.setLevel(_level)
+	root.addHandler(_handler)
+	root.propagate = False
+
+	out = logging.StreamHandler(stream or sys.stderr)
+	out.setFormatter(logging.Formatter(FORMAT))
+	listener = logging.handlers.QueueListener(records, out)
+	listener.start()
+	# What is still queued is written before the program exits
+	atexit.register(listener.stop)
+
+	if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+		signal.signal(signal.SIGUSR1, toggleDebug)
+
+	if unknown:
+		root.warning("Unknown log level %s, logging at INFO", unknown)
+
+def toggleDebug(*args):
+	"""Switches the dfs loggers between debug and the level of setup."""
+	root = logging.getLogger("dfs")
+	if root.level == logging.DEBUG:
+		root.setLevel(_level)
+	else:
+		root.setLevel(logging.DEBUG)
+	root.warning("Log level %s", logging.getLevelName(root.level))
+
+def dropped():
+	"""Returns how many records were dropped because the queue was full."""
+	return _handler.dropped if _handler is not None else 0
@@ -9,75 +9,67 @@
 # when running the script. 
 
 # The client sends a list request packet to the server 
-# and receives a response with a list of files in the form of a string. 
-
-# The string is processed to extract the names and sizes 
-# of the files and print them to the console.
+# and receives a response with a list of files and their sizes,
+# which are printed to the console.  The list comes in pages,
+# each one asked for with the cursor of the previous one.
+# Only the entries of one directory are listed, directories
+# are printed with a / at the end.
 
 # -------------- How to Run ---------------
 # 			    server:port
 # python3 ls.py localhost:1234
+# Only the files starting with log_, in pages of 100:
+# python3 ls.py localhost:1234 log_ 100
+# The files in the directory /logs:
+# python3 ls.py localhost:1234 /logs/
 
-import socket
 import sys
 from Packet import *
 
-# The stripString function processes the list response string 
-# by removing various 'junk' characters such as curly braces and colons, 
-# and splitting the string into a list of file #names and sizes. 
-# The client function establishes a connection to the metadata server using a socket, 
-# sends the list request packet, and receives the list response string. 
-# It then processes the response string and prints the names and sizes of the files to the console. 
-def stripString(str):
-
-	listRec = str
-	listRec = listRec.replace('{', '')
-	listRec = listRec.replace('}', '')
-	listRec = listRec.replace('[', '')
-	listRec = listRec.replace(']', '')
-	listRec = listRec.replace(':', '')
-	listRec = listRec.replace('files', '')
-	listRec = listRec.replace('"', '')
-	listRec = listRec.split(',')
-
-	return listRec
+# Connection to the metadata server, kept open for
+# more requests when client is called again
+connections = ConnectionPool()
 
+# Default number of files asked for in each page
+PAGE_SIZE = 1000
 
 def usage():
-	print ("""Usage: python %s <server>:<port, default=8000>""" % sys.argv[0] )
+	print ("""Usage: python %s <server>:<port, default=8000> <directory/name prefix> <page size, default=1000>""" % sys.argv[0] )
 	sys.exit(0)
 
-# The client function establishes a connection to the metadata server using a socket,
-# sends the list request packet, and receives the list response string.
-# It then processes the response string using the stripString function
-# and prints the names and sizes of the files to the console.
-def client(ip, port):
-	
-	# Create the socket and packet
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	sp = Packet()
-
-	# Connects to the Socket / Server
-	# and build a list packer
-	sock.connect((ip, port))
-	sp.BuildListPacket()
-
-	# Sends the build request packet
-	sock.sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-	# Receive the packet :D
-	rec = sock.recv(1024).decode()
-
-	# Clean the response!
-	listRec = stripString(rec)
-	listLen = len(listRec)
+# listFiles yields the (path, size) of the files and directories
+# in the DFS directory prefix starts with, whose name starts with
+# the rest of prefix, in name order.  Directories have a / at the
+# end of their path and no size.  They are asked for a page at a
+# time, so only one page is ever in memory.
+def listFiles(address, prefix="", page=PAGE_SIZE, pool=connections):
+	cursor = None
+	while True:
+		# Build a list packet for the page after the cursor
+		sp = Packet()
+		sp.BuildListPacket(prefix, cursor, page)
+
+		# Sends the build request packet through a kept
+		# connection and receive the packet :D
+		sp = pool.request(address, sp)
+		for fname, fsize in sp.getFileArray():
+			yield fname, fsize
+
+		cursor = sp.getCursor()
+		if cursor is None:
+			break
+
+# The client function asks the metadata server for the list
+# of files, a page at a time.
+# It then prints the names and sizes of the files to the console.
+def client(ip, port, prefix="", page=PAGE_SIZE):
 
 	# Prints out the given request :)
-	for i in range(0, listLen-1, 2):
-
-		msg = listRec[i] + listRec[i+1]
-		print(f"{msg} bytes")
-
-	sock.close()
+	for fname, fsize in listFiles((ip, port), prefix, page):
+		if fsize is None:
+			print(fname)
+		else:
+			print(f"{fname} {fsize} bytes")
 
 
 # If the script is run as the main module, 
@@ -105,5 +97,17 @@ if __name__ == "__main__":
 	if not ip:
 		usage()
 
+	prefix = ""
+	if len(sys.argv) > 2:
+		prefix = sys.argv[2]
+
+	page = PAGE_SIZE
+	if len(sys.argv) > 3:
+		try:
+			page = int(sys.argv[3])
+		except ValueError:
+			usage()
+		if page <= 0:
+			usage()
 
-	client(ip, port)
+	client(ip, port, prefix, page)
@@ -8,6 +8,142 @@
 #
 
 import sqlite3
+import queue
+import threading
+import contextlib
+
+# Connections are opened once and reused by later requests, there is
+#   one pool per database file.  Each connection is used by one thread
+#   at a time, the one that took it from the pool.
+POOL_SIZE = 32
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(db_name):
+	with _pools_lock:
+		if db_name not in _pools:
+			_pools[db_name] = queue.LifoQueue(POOL_SIZE)
+		return _pools[db_name]
+
+def _open(db_name):
+	#Opens a new connection to the database file, in WAL mode so readers
+	#   do not block the writer, and only syncing at checkpoints.
+	#   Several requests may use the database at once, they wait for the
+	#   others to finish instead of failing.
+	conn = sqlite3.connect(db_name, timeout=30, check_same_thread=False, cached_statements=256)
+	conn.isolation_level = None
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	conn.execute("PRAGMA cache_size=-16384")
+	conn.execute("PRAGMA temp_store=MEMORY")
+	return conn
+
+# Schema migrations.  MIGRATIONS[v] takes a database from version v
+#   to version v + 1, the version is kept in PRAGMA user_version.
+#   Version 0 is the schema made by createdb.py.
+
+def _migrate_block_size(c):
+	#v1: block size of the files, databases made before it was added
+	#   to createdb.py do not have it
+	columns = [row[1] for row in c.execute("PRAGMA table_info(inode)")]
+	if "bsize" not in columns:
+		c.execute("ALTER TABLE inode ADD COLUMN bsize INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_indexes(c):
+	#v2: the blocks of a file are looked up by fid, and the file
+	#   listing and lookups by name are answered from the index alone
+	c.execute("""CREATE INDEX IF NOT EXISTS blockfid ON block(fid)""")
+	c.execute("""CREATE INDEX IF NOT EXISTS inodels ON inode(fname, fsize, bsize)""")
+
+def _migrate_block_index(c):
+	#v3: position of each block in its file, the blocks of a file
+	#   are read in that order
+	c.execute("ALTER TABLE block ADD COLUMN idx INTEGER NOT NULL DEFAULT 0")
+	c.execute("""CREATE INDEX IF NOT EXISTS blockfi ON block(fid, idx)""")
+	c.execute("""DROP INDEX IF EXISTS blockfid""")
+
+def _migrate_block_checksum(c):
+	#v4: CRC-32 of each block, clients check the blocks they read
+	#   against it.  NULL for the blocks saved before.
+	c.execute("ALTER TABLE block ADD COLUMN crc INTEGER")
+
+def _migrate_block_codec(c):
+	#v5: codec each block is compressed with, NULL if it is not, and
+	#   its size as stored in the data nodes
+	c.execute("ALTER TABLE block ADD COLUMN codec TEXT")
+	c.execute("ALTER TABLE block ADD COLUMN csize INTEGER")
+
+def _migrate_chunks(c):
+	#v6: blocks are content addressed.  Each block has the SHA-256 hash
+	#   of its contents, files with the same contents share the chunks
+	#   in the data nodes, so a chunk may be in many blocks of a node.
+	#   The chunk table counts the blocks of files that use each chunk.
+	c.execute("ALTER TABLE block ADD COLUMN hash TEXT")
+	c.execute("""CREATE INDEX IF NOT EXISTS blockhash ON block(hash)""")
+	c.execute("""DROP INDEX IF EXISTS blocknc""")
+	c.execute("""CREATE TABLE IF NOT EXISTS chunk (hash TEXT PRIMARY KEY, refs INTEGER NOT NULL DEFAULT 0)""")
+
+def _migrate_namespace(c):
+	#v7: hierarchical namespace.  Files and directories are inodes named
+	#   by their parent directory and their name in it, so directories
+	#   are listed and entries renamed through the inodepn index.  The
+	#   files saved before go to the top directory.
+	c.execute("""CREATE TABLE inode_ns (fid INTEGER PRIMARY KEY ASC AUTOINCREMENT, parent INTEGER NOT NULL DEFAULT 0, name TEXT NOT NULL, isdir INTEGER NOT NULL DEFAULT 0, fsize INTEGER NOT NULL DEFAULT 0, bsize INTEGER NOT NULL DEFAULT 0)""")
+	c.execute("""INSERT INTO inode_ns (fid, parent, name, isdir, fsize, bsize) SELECT fid, 0, fname, 0, fsize, bsize FROM inode""")
+	c.execute("""DROP TABLE inode""")
+	c.execute("""ALTER TABLE inode_ns RENAME TO inode""")
+	c.execute("""CREATE UNIQUE INDEX inodepn ON inode(parent, name)""")
+
+def _migrate_erasure(c):
+	#v8: erasure coded files.  A file stored in stripes of k data blocks
+	#   and m parity blocks has them in ek and em (0 if it is replicated),
+	#   the parity blocks of each stripe are in the parity table.
+	c.execute("ALTER TABLE inode ADD COLUMN ek INTEGER NOT NULL DEFAULT 0")
+	c.execute("ALTER TABLE inode ADD COLUMN em INTEGER NOT NULL DEFAULT 0")
+	c.execute("""CREATE TABLE IF NOT EXISTS parity (pid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fid INTEGER NOT NULL, stripe INTEGER NOT NULL, idx INTEGER NOT NULL, nid INTEGER NOT NULL, cid TEXT NOT NULL, crc INTEGER, size INTEGER NOT NULL)""")
+	c.execute("""CREATE INDEX IF NOT EXISTS parityfs ON parity(fid, stripe)""")
+
+def _migrate_listing_index(c):
+	#v9: directory listings are answered from the inodels index alone,
+	#   it has the sizes and kinds of the entries after their names.
+	#   The one of v2 went away with the inode table in v7.
+	c.execute("""CREATE INDEX IF NOT EXISTS inodels ON inode(parent, name, isdir, fsize)""")
+
+MIGRATIONS = [_migrate_block_size, _migrate_indexes, _migrate_block_index, _migrate_block_checksum, _migrate_block_codec, _migrate_chunks, _migrate_namespace, _migrate_erasure, _migrate_listing_index]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Node ids never change once a node is registered, they are cached
+#   so committing the blocks of a file does not look them up each time.
+_node_ids = {}
+
+# Paths are resolved one component at a time, by parent directory and
+#   name.  The ids of the directories found are cached by (database,
+#   parent, name), a directory only leaves its entry when it is renamed.
+#   The entries in the top directory have parent ROOT.
+#   Each cached id has the cache generation read before the snapshot it
+#   was read from, and every committed rename starts a new generation
+#   once it is committed, so an id read before a rename (another
+#   connection may read the old entry until the commit) is never used
+#   after it.  The directories a transaction finds or makes are only
+#   cached once it commits.
+ROOT = 0
+_dirs = {}
+_dirs_generation = 0
+_dirs_lock = threading.Lock()
+
+def _renamed():
+	global _dirs_generation
+	with _dirs_lock:
+		_dirs_generation += 1
+		_dirs.clear()
+
+def SplitPath(path):
+	#Returns the components of a /-separated path, empty, repeated
+	#   and . components are dropped.  None if it has .. components.
+	parts = [part for part in path.split("/") if part not in ("", ".")]
+	if ".." in parts:
+		return None
+	return parts
 
 class mds_db:
 
@@ -15,38 +151,115 @@ class mds_db:
 		self.c = None
 		self.db_name=db_name
 		self.conn = None
+		# Directories found or made by the open transaction, cached
+		#   when it commits, and if it renamed anything
+		self.pending = {}
+		self.renamed = False
 	
 	def Connect(self):
-		#Connect to the database file#
+		#Take a connection to the database file from the pool, opening
+		#   a new one if they are all in use#
 		try:
-			self.conn = sqlite3.connect(self.db_name)
+			try:
+				self.conn = _pool(self.db_name).get_nowait()
+			except queue.Empty:
+				self.conn = _open(self.db_name)
 			self.c = self.conn.cursor()
-			self.conn.isolation_level = None
 			return 1
 		except:
 			return 0
 
 	def Close(self):
-		#Close cursor to the database#
+		#Close cursor to the database and give the connection back to the
+		#   pool, closing it if the pool is full#
 		try:
-			#self.conn.commit()
 			self.c.close() 	
+			if self.conn.in_transaction:
+				self.conn.rollback()
+			try:
+				_pool(self.db_name).put_nowait(self.conn)
+			except queue.Full:
+				self.conn.close()
+			self.conn = None
 			return 1
 		except:
 			return 0
 	
+	@contextlib.contextmanager
+	def Transaction(self, immediate=True):
+		#Runs the statements of the with block in one transaction,
+		#   committed at the end of the block and rolled back if it
+		#   raises.  Inside another transaction it is a savepoint, so
+		#   only the statements of the inner block are rolled back.
+		#   immediate takes the write lock at once, for transactions
+		#   that write.
+		#   The directories found by the transaction are cached once it
+		#   commits, a rolled back savepoint forgets them all.
+		if self.conn.in_transaction:
+			self.c.execute("SAVEPOINT item")
+			try:
+				yield
+			except:
+				self.c.execute("ROLLBACK TO item")
+				self.c.execute("RELEASE item")
+				self.pending = {}
+				raise
+			self.c.execute("RELEASE item")
+			return
+
+		generation = _dirs_generation
+		self.pending = {}
+		self.renamed = False
+		self.c.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+		try:
+			yield
+		except:
+			self.c.execute("ROLLBACK")
+			self.pending = {}
+			raise
+		self.c.execute("COMMIT")
+
+		pending, self.pending = self.pending, {}
+		if self.renamed:
+			self.renamed = False
+			_renamed()
+		else:
+			for key, did in pending.items():
+				_dirs[key] = (did, generation)
+
+	def Migrate(self):
+		#Brings the database schema up to SCHEMA_VERSION, applying the
+		#   migrations it is missing in order.  Each migration runs in
+		#   its own transaction with the version bump.  Returns the version.
+		version = self.c.execute("PRAGMA user_version").fetchone()[0]
+		while version < SCHEMA_VERSION:
+			self.c.execute("BEGIN IMMEDIATE")
+			try:
+				# Another server may have migrated meanwhile
+				version = self.c.execute("PRAGMA user_version").fetchone()[0]
+				if version < SCHEMA_VERSION:
+					MIGRATIONS[version](self.c)
+					version += 1
+					self.c.execute("PRAGMA user_version = %d" % version)
+				self.c.execute("COMMIT")
+			except:
+				self.c.execute("ROLLBACK")
+				raise
+		return version
+
 	def AddDataNode(self, address, port):
 		#Adds new data node to the metadata server
 		#   Receives IP address and port 
 		#   I.E. the information to connect to the data node
+		#   Returns 0 if the node is already registered.
 
-		query = """insert into dnode (address, port) values ("%s", %s)""" % (address, port)
+		query = """insert into dnode (address, port) values (?, ?)"""
 		try:
-			self.c.execute(query)
+			self.c.execute(query, (address, port))
 			return self.c.lastrowid 
 		except sqlite3.IntegrityError as e: 
 			#print type(e), dir(e), e
-			if e.message.split()[-1].strip() == "unique":
+			if "UNIQUE" in str(e):
 				return 0
 			else:
 				raise
@@ -55,70 +268,378 @@ class mds_db:
 	def CheckNode(self, address, port):
 		#Check if node is in database and returns name, address, port
         #           for connection.
-		query = """select nid from dnode where address="%s" and port=%s""" % (address, port)
-		try:
-			self.c.execute(query)
-		except:
+		query = """select nid from dnode where address=? and port=?"""
+		row = self.c.execute(query, (address, port)).fetchone()
+		if row is None:
 			return None
-		return self.c.fetchone()[0]
+		return row[0]
 
 
 	def GetDataNodes(self):
 		# Returns a list of data node tuples (address, port).  
 		# Useful to know to which datanodes chunks can be send.
-		query = """select address, port from dnode where 1"""
+		query = """select address, port from dnode order by nid"""
 		self.c.execute(query)
 		return self.c.fetchall()
 
 
-	def InsertFile(self, fname, fsize):
-		#Create the inode attributes.  For this project the name of the
-		#   file and its size.
-		query = """insert into inode (fname, fsize) values ("%s", %s)""" % (fname, fsize)
-		try:
-			self.c.execute(query)
-			return 1
-		except:
+	def CachedDir(self, key):
+		#Returns the cached id of a directory, None if it is not cached.
+		#   A transaction sees the directories it found first, and
+		#   none of the others once it renamed something.
+		if self.conn.in_transaction:
+			if key in self.pending:
+				return self.pending[key]
+			if self.renamed:
+				return None
+		entry = _dirs.get(key)
+		if entry is None or entry[1] != _dirs_generation:
+			return None
+		return entry[0]
+
+	def CacheDir(self, key, did, generation):
+		#Caches the id of a directory read after the cache was at
+		#   generation, or keeps it for the end of the transaction.
+		if self.conn.in_transaction:
+			self.pending[key] = did
+		else:
+			_dirs[key] = (did, generation)
+
+	def LookupDir(self, parts):
+		#Returns the id of the directory with the path components parts,
+		#   None if there is no such directory.
+		generation = _dirs_generation
+		did = ROOT
+		for name in parts:
+			key = (self.db_name, did, name)
+			child = self.CachedDir(key)
+			if child is None:
+				query = """select fid from inode where parent=? and name=? and isdir=1"""
+				row = self.c.execute(query, (did, name)).fetchone()
+				if row is None:
+					return None
+				child = row[0]
+				self.CacheDir(key, child, generation)
+			did = child
+		return did
+
+	def Lookup(self, path):
+		#Returns the (id, is directory, size, block size) of the file or
+		#   directory path, None if there is none.  The top directory
+		#   is ROOT.
+		parts = SplitPath(path)
+		if parts is None:
+			return None
+		if not parts:
+			return ROOT, 1, 0, 0
+		parent = self.LookupDir(parts[:-1])
+		if parent is None:
+			return None
+		query = """select fid, isdir, fsize, bsize from inode where parent=? and name=?"""
+		return self.c.execute(query, (parent, parts[-1])).fetchone()
+
+	def MakeDir(self, path):
+		#Creates the directory path and the missing directories above it.
+		#   Returns its id, None if there is a file in the way.
+		parts = SplitPath(path)
+		if parts is None:
+			return None
+		did = ROOT
+		with self.Transaction():
+			for name in parts:
+				key = (self.db_name, did, name)
+				child = self.CachedDir(key)
+				if child is not None:
+					did = child
+					continue
+				self.c.execute("""insert or ignore into inode (parent, name, isdir) values (?, ?, 1)""", (did, name))
+				query = """select fid, isdir from inode where parent=? and name=?"""
+				child, isdir = self.c.execute(query, (did, name)).fetchone()
+				if not isdir:
+					return None
+				self.CacheDir(key, child, None)
+				did = child
+		return did
+
+	def Rename(self, src, dst):
+		#Moves the file or directory src to dst, with all there is under
+		#   it: only its own inode changes.  The directory dst goes in must
+		#   exist and dst must not.  Returns 0 if it can not be renamed.
+		sparts, dparts = SplitPath(src), SplitPath(dst)
+		if not sparts or not dparts:
 			return 0
+		with self.Transaction():
+			sparent = self.LookupDir(sparts[:-1])
+			dparent = self.LookupDir(dparts[:-1])
+			if sparent is None or dparent is None:
+				return 0
+			query = """select fid, isdir from inode where parent=? and name=?"""
+			row = self.c.execute(query, (sparent, sparts[-1])).fetchone()
+			if row is None:
+				return 0
+			fid, isdir = row
+
+			# A directory can not go under itself
+			did = dparent
+			while isdir and did != ROOT:
+				if did == fid:
+					return 0
+				did = self.c.execute("""select parent from inode where fid=?""", (did,)).fetchone()[0]
+
+			try:
+				self.c.execute("""update inode set parent=?, name=? where fid=?""", (dparent, dparts[-1], fid))
+			except sqlite3.IntegrityError:
+				return 0
+			# The cache is left alone until the rename commits
+			self.renamed = True
+			self.pending.pop((self.db_name, sparent, sparts[-1]), None)
+		return 1
+
+	def InsertFile(self, fname, fsize, bsize=0, k=0, m=0):
+		#Create the inode attributes.  For this project the path of the
+		#   file, its size and the size of the blocks it was split in,
+		#   and for an erasure coded file the data and parity blocks of
+		#   its stripes.  The missing directories above it are created.
+		#   Returns 0 if there is a file or directory at that path already,
+		#   None if the path is not valid or a file is in the way of its
+		#   directories.
+		parts = SplitPath(fname)
+		if not parts:
+			return None
+		query = """insert into inode (parent, name, fsize, bsize, ek, em) values (?, ?, ?, ?, ?, ?)"""
+		with self.Transaction():
+			parent = self.MakeDir("/".join(parts[:-1]))
+			if parent is None:
+				return None
+			try:
+				self.c.execute(query, (parent, parts[-1], fsize, bsize, k, m))
+			except sqlite3.IntegrityError:
+				return 0
+		return 1
 	
 
+	def DeleteFile(self, fname):
+		#Removes a file and its blocks from the DFS.  Returns 0 if
+		#   the file is not in the DFS.
+		fid, dummy1 = self.GetFileInfo(fname)
+		if not fid:
+			return 0
+		with self.Transaction():
+			self.ReleaseChunks(fid)
+			self.c.execute("""delete from block where fid=?""", (fid,))
+			self.c.execute("""delete from parity where fid=?""", (fid,))
+			self.c.execute("""delete from inode where fid=?""", (fid,))
+		return 1
+
+	def AbortFile(self, fname):
+		#Removes a file whose put was given up, before any of its blocks
+		#   were committed.  Returns 0 if the file is not in the DFS or
+		#   its blocks were committed: only a put in progress is aborted.
+		with self.Transaction():
+			fid, dummy1 = self.GetFileInfo(fname)
+			if not fid:
+				return 0
+			query = """select exists (select 1 from block where fid=?) or exists (select 1 from parity where fid=?)"""
+			if self.c.execute(query, (fid, fid)).fetchone()[0]:
+				return 0
+			self.c.execute("""delete from inode where fid=?""", (fid,))
+		return 1
+
 	def GetFileInfo(self, fname):
 		#Given a filename, if the file is stored in DFS
      	#	   return its filename id and fsize.  Internal use only.
 		#   Does not have to be accessed from the metadata server.
-		query = """select fid, fsize from inode where fname="%s" """ % fname
-		try:
-			self.c.execute(query)
-			result = self.c.fetchone()
-			return result[0], result[1]
-		except:
+		row = self.Lookup(fname)
+		if row is None or row[1]:
 			return None, None
+		return row[0], row[2]
 
-	def GetFiles(self):
+	def StatFile(self, fname):
+		#Returns the size, block size and if it is a directory of a file
+		#   or directory, None if it is not in the DFS.
+		row = self.Lookup(fname)
+		if row is None:
+			return None
+		return row[2], row[3], bool(row[1])
+
+	def GetFiles(self, prefix="", after=None, limit=-1):
 		#Returns the attributes of the files stored in the DFS"""
-		#File Name and Size"""
-		query = """select fname, fsize from inode where 1""" 
-		self.c.execute(query)	
-		return self.c.fetchall()
+		#File Path and Size"""
+		#   Only the entries of one directory: prefix is the path of the
+		#   directory followed by the start of the names listed, as in
+		#   /logs/ or /logs/2024-.  Only the names after the path after,
+		#   and at most limit of them (all if negative), in name order.
+		#   Directories have a / at the end of their path and no size.
+		#   The rows come straight from the inodels index.
+		dirpath, sep, start = prefix.rpartition("/")
+		parts = SplitPath(dirpath)
+		did = None if parts is None else self.LookupDir(parts)
+		if did is None:
+			return []
+		base = "".join("/" + part for part in parts)
 
-	def AddBlockToInode(self, fname, blocks):
+		query = """select name, isdir, fsize from inode where parent=? and name >= ? and name > ?"""
+		args = [did, start, (after or "").rstrip("/").rpartition("/")[2]]
+		if start:
+			# Names starting with start are below start with its
+			# last character incremented
+			query += """ and name < ?"""
+			args.append(start[:-1] + chr(ord(start[-1]) + 1))
+		query += """ order by name limit ?"""
+		args.append(limit)
+		self.c.execute(query, args)
+		return [(base + "/" + name + "/", None) if isdir else (base + "/" + name, fsize) for name, isdir, fsize in self.c.fetchall()]
+
+	def GetNodeID(self, address, port):
+		#Same as CheckNode, but remembers the ids already looked up
+		key = (self.db_name, address, port)
+		nid = _node_ids.get(key)
+		if nid is None:
+			nid = self.CheckNode(address, port)
+			if nid is not None:
+				_node_ids[key] = nid
+		return nid
+
+	def AddBlockToInode(self, fname, blocks, parity=()):
 		#Once the Inode was created with the file's attribute
   	    #       and the data copied to the data nodes.  The inode is 
 		#   updated to point to the data blocks. So this function receives
-        #           the filename and a list of tuples with (node id, chunk id)
+        #           the filename and a list of tuples with 
+		#           (block index, address, port, chunk id[, checksum[, codec, stored size[, hash]]])
+		#   and for an erasure coded file the parity blocks, as
+		#           (stripe, parity index, address, port, chunk id, checksum, size)
+		#   All the blocks are written in one transaction, replacing
+		#   any committed before, so the commit can be retried.
+		#   Returns None if the file is not in the DFS and 0 if a 
+		#   node is not registered.
 		
 		fid, dummy1= self.GetFileInfo(fname) 
 		if not fid:
 			return None
-		for address, port, chunkid in blocks:
-			nid = self.CheckNode(address, port)
-			if nid:
-				query = """insert into block (nid, fid, cid) values (%s, %s, "%s")""" % (nid, fid, chunkid)
-				self.c.execute(query)
-			else:
+
+		rows = []
+		for block in blocks:
+			blockidx, address, port, chunkid = block[:4]
+			crc = block[4] if len(block) > 4 else None
+			codec, csize = block[5:7] if len(block) > 6 else (None, None)
+			blockhash = block[7] if len(block) > 7 else None
+			nid = self.GetNodeID(address, port)
+			if not nid:
 				return 0 
+			rows.append((fid, blockidx, nid, chunkid, crc, codec, csize, blockhash))
+
+		parity_rows = []
+		for stripe, pidx, address, port, chunkid, crc, size in parity:
+			nid = self.GetNodeID(address, port)
+			if not nid:
+				return 0
+			parity_rows.append((fid, stripe, pidx, nid, chunkid, crc, size))
+
+		# Each block of the file counts once for its chunk,
+		# no matter how many copies it has
+		refs = {}
+		for row in rows:
+			if row[7] is not None:
+				refs.setdefault(row[1], row[7])
+
+		with self.Transaction():
+			self.ReleaseChunks(fid)
+			self.c.execute("""delete from block where fid=?""", (fid,))
+			query = """insert into block (fid, idx, nid, cid, crc, codec, csize, hash) values (?, ?, ?, ?, ?, ?, ?, ?)"""
+			self.c.executemany(query, rows)
+			self.c.execute("""delete from parity where fid=?""", (fid,))
+			query = """insert into parity (fid, stripe, idx, nid, cid, crc, size) values (?, ?, ?, ?, ?, ?, ?)"""
+			self.c.executemany(query, parity_rows)
+			query = """insert into chunk (hash, refs) values (?, 1) on conflict(hash) do update set refs = refs + 1"""
+			self.c.executemany(query, [(h,) for h in refs.values()])
 		return 1
 
+	def ReleaseChunks(self, fid):
+		#Drops the references of the blocks of a file to their chunks,
+		#   chunks no file uses anymore are forgotten.  Must be called
+		#   in the transaction that deletes the blocks.
+		query = """select distinct idx, hash from block where fid=? and hash is not null"""
+		hashes = [(h,) for idx, h in self.c.execute(query, (fid,)).fetchall()]
+		self.c.executemany("""update chunk set refs = refs - 1 where hash=?""", hashes)
+		self.c.execute("""delete from chunk where refs <= 0""")
+
+	def GetChunks(self, hashes):
+		#Returns the chunks already stored with any of the given hashes,
+		#   by hash, as (chunk id, checksum, codec, stored size, [(address,
+		#   port)]) with the data nodes that hold a copy of the chunk.
+		found = {}
+		hashes = list(hashes)
+		# SQLite limits the parameters of a query
+		for i in range(0, len(hashes), 500):
+			batch = hashes[i:i + 500]
+			query = """select hash, cid, crc, codec, csize, address, port from block join dnode on dnode.nid = block.nid where hash in (%s)""" % ", ".join("?" * len(batch))
+			for blockhash, cid, crc, codec, csize, address, port in self.c.execute(query, batch):
+				chunk = found.setdefault((blockhash, cid), (cid, crc, codec, csize, []))
+				if (address, port) not in chunk[4]:
+					chunk[4].append((address, port))
+
+		# The same contents may have been saved more than once, with
+		#   different copies.  Only the chunk id with the most copies.
+		chunks = {}
+		for (blockhash, cid), chunk in found.items():
+			if blockhash not in chunks or len(chunk[4]) > len(chunks[blockhash][4]):
+				chunks[blockhash] = chunk
+		return chunks
+
+	def GetBlockMap(self, fname, offset=0, length=None):
+		#Returns the file size, block size and blocks of a file, in file
+		#   order, as (block index, address, port, chunk id, checksum, codec,
+		#   stored size) tuples.  Only the blocks that overlap the length
+		#   bytes from offset, to the end of the file if length is None.
+		#   None, None, None if the file is not in the DFS.
+		row = self.Lookup(fname)
+		if row is None or row[1]:
+			return None, None, None
+		fid, dummy1, fsize, bsize = row
+
+		end = fsize if length is None else min(fsize, offset + length)
+		if end <= offset:
+			return fsize, bsize, []
+		first, last = 0, -1
+		if bsize > 0:
+			first, last = offset // bsize, (end - 1) // bsize
+
+		query = """select idx, address, port, cid, crc, codec, csize from block join dnode on dnode.nid = block.nid where block.fid=? and block.idx >= ? and (? < 0 or block.idx <= ?) order by block.idx"""
+		self.c.execute(query, (fid, first, last, last))
+		return fsize, bsize, self.c.fetchall()
+
+	def GetStripes(self, fname, blocks):
+		#Returns the k and m of an erasure coded file and, for the stripes
+		#   the given block indexes are in, by stripe, its data blocks as
+		#   in GetBlockMap and its parity blocks as (parity index, address,
+		#   port, chunk id, checksum, size) tuples.  k is 0 and there are
+		#   no stripes if the file is replicated or not in the DFS.
+		row = self.Lookup(fname)
+		if row is None or row[1]:
+			return 0, 0, {}
+		fid = row[0]
+		k, m = self.c.execute("""select ek, em from inode where fid=?""", (fid,)).fetchone()
+		if not k:
+			return 0, 0, {}
+
+		# The stripes of a range of blocks are next to each other,
+		#   they are all read with one query for the data blocks and
+		#   one for the parity blocks
+		wanted = set(idx // k for idx in blocks)
+		if not wanted:
+			return k, m, {}
+		first, last = min(wanted), max(wanted)
+		stripes = {stripe: ([], []) for stripe in sorted(wanted)}
+		query = """select idx, address, port, cid, crc, codec, csize from block join dnode on dnode.nid = block.nid where block.fid=? and block.idx >= ? and block.idx < ? order by block.idx"""
+		for row in self.c.execute(query, (fid, first * k, (last + 1) * k)).fetchall():
+			if row[0] // k in stripes:
+				stripes[row[0] // k][0].append(row)
+		query = """select stripe, idx, address, port, cid, crc, size from parity join dnode on dnode.nid = parity.nid where parity.fid=? and parity.stripe >= ? and parity.stripe <= ? order by parity.stripe, parity.idx"""
+		for row in self.c.execute(query, (fid, first, last)).fetchall():
+			if row[0] in stripes:
+				stripes[row[0]][1].append(row[1:])
+		return k, m, stripes
+
 	def GetFileInode(self, fname):
 		#Knowing the file name this function return the whole Inode information
 	    #       I.E. Attributes and the list of data blocks with all the information to access 
@@ -126,7 +647,6 @@ class mds_db:
 		fid, fsize = self.GetFileInfo(fname)
 		if not fid:
 			return None, None
-		query = """select address, port, cid from dnode, block where dnode.nid = block.nid and block.fid=%s""" % fid
-		self.c.execute(query)
+		query = """select address, port, cid from block join dnode on dnode.nid = block.nid where block.fid=? order by block.idx"""
+		self.c.execute(query, (fid,))
 		return fsize, self.c.fetchall() 
-		
@@ -9,35 +9,173 @@
 # The server uses the mds_db library to interact with a MySQL database, 
 # which stores information about the data nodes and files in the DFS. 
 
-# The server supports four types of requests: 
+# The server supports six types of requests: 
 # REGISTER, which registers a new data node with the server; 
 # LIST, which retrieves a list of files from the database and sends it to the client; 
 # PUT, which inserts a new file into the database and sends data nodes to save the file; 
+# DBLKS, which records in one transaction the data blocks of a file once they are saved; 
+# HB, the heartbeat data nodes send with their free space and load. 
 # GET, which retrieves a file from the DFS and sends it to the client. 
 
 # The server uses the Packet class to encode and decode packets for communication with the clients. 
 # The program can be run by passing a port number as an argument, 
 # with a default value of 8000 if no argument is provided.
+# Many clients are served at once, either with a thread per connection
+# (threaded, the default) or with an asyncio event loop (asyncio).
 
 # 					by default localhost port
 # Running:  python3 meta-data.py 1234
+# Running:  python3 meta-data.py 1234 asyncio
+# Running:  python3 meta-data.py 1234 threaded 3	(3 copies of each block)
+# Files put erasure coded (see DFScopy.py) are not replicated: each
+# stripe of k data blocks and its m parity blocks go to k + m nodes.
 
 
 from mds_db import *
 from Packet import *
+from metrics import Metrics
+from erasure import MAX_BLOCKS
+import logs
 import sys
+import socket
+import time
+import random
+import sqlite3
+import asyncio
+import threading
 import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+# Server modes, selected from the command line
+MODES = ["threaded", "asyncio"]
+
+# Threads running database work in asyncio mode
+WORKERS = 16
+
+log = logs.getLogger("meta-data")
+
+# Default number of copies of each block, a put can ask for another
+REPLICATION = 1
+
+# Most files answered in a page of a listing
+LIST_PAGE = 1000
+
+# Requests a batch may carry, and the ones of them that write
+BATCH_COMMANDS = ["put", "get", "dblks", "have", "stat", "list", "mkdir", "rename", "abort"]
+BATCH_WRITES = ["put", "dblks", "mkdir", "rename", "abort"]
+
+# Largest size SQLite stores, bigger ones can not be a file or a block
+MAX_SIZE = (1 << 63) - 1
+
+# Errors a handler raises on a request with fields of the wrong shape or
+# type that it did not check, the request is answered NAK
+BAD_REQUEST = (TypeError, ValueError, AttributeError, OverflowError)
+
+# Seconds without a heartbeat after which a data node is taken as dead,
+# data nodes send one every few seconds (see data-node.py)
+DEAD_AFTER = 10
 
 def usage():
-	print ("""Usage: python %s <port, default=8000>""" % sys.argv[0] )
+	print ("""Usage: python %s <port, default=8000> <mode: threaded|asyncio, default=threaded> <replication, default=1>""" % sys.argv[0] )
 	sys.exit(0)
 
 
+# Paths in the DFS are absolute, /dir/name.  Relative paths are taken
+# from the top directory and empty or . components are dropped,
+# paths with .. components are not valid and cleaned to "", and so
+# is anything that is not a string.
 def clean_path(filename):
-	str = filename.split('/')
-	return str[-1]
-
-class MetadataTCPHandler(socketserver.BaseRequestHandler):
+	if not isinstance(filename, str):
+		return ""
+	parts = SplitPath(filename)
+	if parts is None:
+		return ""
+	return "/" + "/".join(parts)
+
+# NodeStates keeps in memory what the data nodes report in their
+# heartbeats: free bytes, number of blocks, transfers in flight
+# and when they were last heard of.  Put answers are placed with
+# it, and dead nodes are left out of put and get answers.
+class NodeStates:
+
+	def __init__(self, nodes):
+		self.lock = threading.Lock()
+		self.random = random.Random()
+		self.nodes = {}
+		# Nodes known from before a restart get DEAD_AFTER
+		# seconds to send their first heartbeat
+		for addr, port in nodes:
+			self.register(addr, port)
+
+	def register(self, addr, port):
+		with self.lock:
+			self.nodes[(addr, port)] = {"free": None, "blocks": 0, "inflight": 0, "seen": time.monotonic()}
+
+	def heartbeat(self, addr, port, free, blocks, inflight):
+		"""Records a heartbeat, False if the node is not registered"""
+		with self.lock:
+			state = self.nodes.get((addr, port))
+			if state is None:
+				return False
+			state.update(free=free, blocks=blocks, inflight=inflight, seen=time.monotonic())
+			return True
+
+	def isAlive(self, node):
+		state = self.nodes.get(tuple(node))
+		return state is not None and time.monotonic() - state["seen"] < DEAD_AFTER
+
+	def alive(self):
+		"""Returns the nodes that are alive"""
+		with self.lock:
+			return [node for node in self.nodes if self.isAlive(node)]
+
+	def place(self, nblocks, replicas):
+		"""Picks the chain of data nodes of each block, replicas
+		   different live nodes each.  Nodes are picked at random,
+		   weighted by their free space and discounted by the
+		   transfers they have in flight, so blocks spread over the
+		   nodes and go more often where there is more room."""
+		with self.lock:
+			nodes = [node for node in self.nodes if self.isAlive(node)]
+			known = [self.nodes[n]["free"] for n in nodes if self.nodes[n]["free"] is not None]
+			default = sum(known) / len(known) if known else 1
+			weights = []
+			for node in nodes:
+				state = self.nodes[node]
+				free = state["free"] if state["free"] is not None else default
+				weights.append( max(free, 1) / (1 + state["inflight"]) )
+
+		replicas = min(replicas, len(nodes))
+		chains = []
+		for i in range(nblocks):
+			left, left_weights, chain = list(nodes), list(weights), []
+			for j in range(replicas):
+				k = self.random.choices(range(len(left)), left_weights)[0]
+				chain.append( left.pop(k) )
+				left_weights.pop(k)
+			chains.append(chain)
+		return chains
+
+
+# The MetadataService answers the requests.  Each handler receives
+# the request packet and returns the response packet instead of
+# writing to a socket, so the same handlers serve the threaded
+# and the asyncio servers.  Every request gets its own database
+# connection, so requests can be served at once from many threads.
+class MetadataService:
+
+	def __init__(self, db_name="dfs.db", replication=REPLICATION):
+		self.db_name = db_name
+		self.replication = replication
+		# Counters and latencies answered to stats requests
+		self.metrics = Metrics()
+
+		# Older databases are migrated to the current schema
+		db = mds_db(self.db_name)
+		db.Connect()
+		db.Migrate()
+		self.nodes = NodeStates(db.GetDataNodes())
+		db.Close()
 
 	def handle_reg(self, db, p):
 		"""Register a new client to the DFS  ACK if successfully REGISTERED
@@ -46,36 +184,63 @@ class MetadataTCPHandler(socketserver.BaseRequestHandler):
 		addr = p.getAddr()
 		port = p.getPort()
 		
-		print("Handle Register!")
-		print(f"addr: {addr}")
-		print(f"port: {port}")
+		log.info("Registering data node %s:%s", addr, port)
 
-		# Check if the Data Node is already registered
+		# Register the Data Node, the unique index on
+		# (address, port) tells if it was already registered.
 		# Replies with the appropiate response:
 		# ACK -- Sucessful
 		# DUP -- Duplicate
 		# NAK -- Failure
-		if (addr, port) not in db.GetDataNodes():
-			db.AddDataNode(addr, port)
-			self.request.sendall(bytes("ACK", 'UTF-8'))
-			print(f"Available Nodes: {db.GetDataNodes()}")
-		elif (addr, port) in db.GetDataNodes():
-			self.request.sendall(bytes("DUP", 'UTF-8'))
+		sp = Packet()
+		try:
+			if db.AddDataNode(addr, port):
+				sp.BuildStatusResponse("ACK")
+			else:
+				sp.BuildStatusResponse("DUP")
+			self.nodes.register(addr, port)
+			log.info("Available Nodes: %s", self.nodes.alive())
+		except sqlite3.Error:
+			sp.BuildStatusResponse("NAK")
+		return sp
+
+
+	# Data Nodes send a heartbeat every few seconds with
+	# their free space, number of blocks and transfers
+	def handle_hb(self, db, p):
+		"""Record the load of a Data Node.  ACK, or NAK if the
+			node is not registered so it registers again.
+		"""
+		free, blocks, inflight = p.getLoad()
+
+		sp = Packet()
+		if self.nodes.heartbeat(p.getAddr(), p.getPort(), free, blocks, inflight):
+			sp.BuildStatusResponse("ACK")
 		else:
-			self.request.sendall(bytes("NAK", 'UTF-8'))
+			sp.BuildStatusResponse("NAK")
+		return sp
 
 
 	# The Client's ls.py executes the following which 
 	# returns a list of files from the database
-	def handle_list(self, db):
-		"""Get the file list from the database and send list to client"""
+	def handle_list(self, db, p):
+		"""Get a page of the file list from the database and send list
+		   to client, with the cursor of the next page.
+		"""
 
 		# print("Inside Handle List!")
 		sp = Packet()
 
-		sp.BuildListResponse(db.GetFiles())
-		self.request.sendall(bytes(sp.getEncodedPacket(), 'UTF-8'))
-		print("Handle List -- Request Sent!")
+		# Pages are never bigger than LIST_PAGE files, so a
+		# listing takes the same memory however many files
+		# there are
+		prefix, cursor, limit = p.getListQuery()
+		limit = LIST_PAGE if not limit or limit < 1 else min(limit, LIST_PAGE)
+		files = db.GetFiles(prefix, cursor, limit)
+		cursor = files[-1][0] if len(files) == limit else None
+
+		sp.BuildListResponse(files, cursor)
+		return sp
 
 
 	# If it's Copy's putTo will check if it's already
@@ -85,113 +250,505 @@ class MetadataTCPHandler(socketserver.BaseRequestHandler):
 		   the file.
 		"""
 
-		print("Getting File Info from Packet!")
-		fname , fsize = p.getFileInfo()
+		fname , fsize = p.getFileInfo() or (None, None)
+		bsize = p.getBlockSize()
+		replicas = p.getReplicas()
+		erasure = p.getErasure()
+		# The sizes, copies and stripes come from the client, nothing
+		# is inserted for a put whose blocks can not be counted,
+		# stored or placed
+		sized = type(fsize) is int and 0 <= fsize <= MAX_SIZE and (bsize is None or (type(bsize) is int and 0 < bsize <= MAX_SIZE))
+		sized = sized and (replicas is None or (type(replicas) is int and replicas >= 1))
+		coded = erasure is None or (len(erasure) == 2 and all(type(n) is int for n in erasure))
+		bsize = bsize or fsize
 
 		# print(f"fname: {fname} fsize: {fsize}")
-		# print(f"getFiles {db.GetFiles()}")
 
-		# check with if fname and fsize in db.GetFiles() lol
-		# Check if duplicated already
-		if len(db.GetFiles()) > 0 and fname in list(zip(*db.GetFiles()))[0]:
-			self.request.sendall(bytes("DUP", 'UTF-8'))
-
-		# If they're not, sends packet(s) to the Data Node(s)
-		# to copy the file to the DFS
+		# Inserting is the duplicate check, the file name is
+		# UNIQUE so two clients putting the same file at once
+		# can not both get data nodes
+		log.debug("Inserting File (%s, %s)", fname, fsize)
+		fname = clean_path(fname)
+		# print(f"\nClean Path ({fname})\n")
+		k, m = erasure if erasure and coded else (0, 0)
+		inserted = None
+		if sized and coded and (not erasure or (k >= 1 and m >= 1 and k + m <= MAX_BLOCKS)):
+			inserted = db.InsertFile(fname, fsize, bsize, k, m)
+		# Paths that are not valid are NAK, DUP is only for
+		# a name already taken
+		if inserted is None:
+			p.BuildStatusResponse("NAK")
+		elif not inserted:
+			p.BuildStatusResponse("DUP")
+
+		# If they're not, sends the chain of Data Node(s)
+		# each block of the file is copied to
+		elif erasure:
+			# Each stripe goes to k + m different nodes, so a node
+			# lost loses at most one block of a stripe
+			nblocks = (fsize + bsize - 1) // bsize if bsize else 0
+			stripes = self.nodes.place((nblocks + k - 1) // k, k + m)
+			if any(len(stripe) < k + m for stripe in stripes):
+				db.DeleteFile(fname)
+				p.BuildStatusResponse("NAK")
+			else:
+				chains = [[stripes[i // k][i % k]] for i in range(nblocks)]
+				p.BuildPutResponse(chains, [stripe[k:] for stripe in stripes])
 		else:
 			# print("Building!")
-			p.BuildPutResponse(db.GetDataNodes())
-			self.request.sendall(bytes(p.getEncodedPacket(), 'UTF-8'))
-			# print("Inserting!")
-			print(f"\nInserting File ({fname}, {fsize})\n")
-			fname = clean_path(fname)
-			# print(f"\nClean Path ({fname})\n")
-			db.InsertFile(fname, fsize)
+			replicas = replicas or self.replication
+			nblocks = (fsize + bsize - 1) // bsize if bsize else 0
+			chains = self.nodes.place(nblocks, replicas)
+			if nblocks and not chains[0]:
+				db.DeleteFile(fname)
+				p.BuildStatusResponse("NAK")
+			else:
+				p.BuildPutResponse(chains)
+		return p
+
+
+	# Once Copy's putTo has sent every block to the Data Node(s)
+	# it commits where they are, all the blocks in one packet
+	def handle_dblks(self, db, p):
+		"""Record the data blocks of a file: block index, data node,
+		   chunk id, checksum, codec and stored size, and its parity
+		   blocks if it is erasure coded.  ACK if they were saved,
+		   NAK if not.
+		"""
+
+		fname = clean_path(p.getFileName())
+		blocks = p.getDataBlocks()
+		parity = p.getParity() or ()
+		log.debug("Committing %d blocks and %d parity blocks of %s", len(blocks), len(parity), fname)
+
+		sp = Packet()
+		try:
+			if db.AddBlockToInode(fname, blocks, parity):
+				sp.BuildStatusResponse("ACK")
+			else:
+				sp.BuildStatusResponse("NAK")
+		except sqlite3.Error:
+			sp.BuildStatusResponse("NAK")
+		return sp
+
+
+	# Before sending the blocks of a file Copy's putTo asks
+	# which of them are already stored, by the hash of their
+	# contents, and only sends the others
+	def handle_have(self, db, p):
+		"""Answers the chunks already stored with the hashes asked
+		   for, that have a copy in a live data node, with the live
+		   nodes that hold a copy.  Clients only reuse the chunks with
+		   as many live copies as they ask for.
+		"""
+
+		chunks = {}
+		for blockhash, (cid, crc, codec, csize, nodes) in db.GetChunks(p.getHashes()).items():
+			nodes = [node for node in nodes if self.nodes.isAlive(node)]
+			if nodes:
+				chunks[blockhash] = (cid, crc, codec, csize, nodes)
+		log.debug("%d of %d blocks already stored", len(chunks), len(p.getHashes()))
+
+		sp = Packet()
+		sp.BuildHaveResponse(chunks)
+		return sp
+
+
+	# Copy's putTo gives up on a file when a block can not be
+	# saved, the file is removed so it can be put again
+	def handle_abort(self, db, p):
+		"""Removes a file whose blocks were never committed.  ACK if it
+		   was removed, NAK if it is not in the DFS or has its blocks.
+		"""
+
+		fname = clean_path(p.getFileName())
+		log.debug("Aborting the put of %s", fname)
+		sp = Packet()
+		if fname and db.AbortFile(fname):
+			sp.BuildStatusResponse("ACK")
+		else:
+			sp.BuildStatusResponse("NAK")
+		return sp
 
 
 	# Copy's getFrom DFS will verify if it exists
-	# then shall send packet(s) to the Data Node(s)
-	# to copy the file from the DFS 
-	# to the client's specified >file< path
+	# then shall send the block map of the file,
+	# where each block is and its exact length,
+	# so the client only asks the Data Node(s) that hold them
 	def handle_get(self, db, p):
-		"""Check if file is in database and (then?) return list of
-			server nodes that contain the file.
+		"""Check if file is in database and return its block map:
+			index, offset, length, chunk id, locations, checksum, codec
+			and stored size of each block.  Only the blocks in the
+			byte range of the packet, if it has one.
 		"""
 
-		fsize, fInfo = db.GetFileInode( p.getFileName() )
+		# Only the blocks that overlap the range asked for,
+		# the whole file if no range was asked for
+		offset, length = p.getRange()
+		fname = clean_path(p.getFileName())
+		ranged = type(offset) is int and 0 <= offset <= MAX_SIZE and (length is None or (type(length) is int and 0 <= length <= MAX_SIZE))
+		fsize, bsize, rows = db.GetBlockMap( fname, offset, length ) if ranged else (None, None, None)
 		# print(f"fsize: {fsize}")
 
-		# -- Working -- 
-		print(db.GetDataNodes())
-		# Temporary Solution
-		p.BuildGetResponse( db.GetDataNodes() , fsize )
-		
-		# For some unknown reason, this doesn't works :(
-		# fname, fsize = p.getFileInfo()
-		# print(f"name: {fname} fsize: {fsize}")
+		# The range is not valid, the file is not in the DFS,
+		# or its blocks were never committed
+		if fsize is None or (offset < fsize and length != 0 and not rows):
+			p.BuildStatusResponse("NAK")
+			return p
+
+		blocks = self.blockEntries(rows, fsize, bsize)
+
+		# Erasure coded files come with the stripes of their blocks,
+		# a block whose data node fails is rebuilt from the rest of
+		# its stripe.  Some block has no copy in a live node, only
+		# erasure coded files can do without it, if its stripe has
+		# k blocks left.
+		stripes, short = self.stripesOf(db, fname, blocks, fsize, bsize)
+		lost = [block[0] for block in blocks if not block[4]]
+		if lost and (stripes is None or any(idx // stripes[0] in short for idx in lost)):
+			p.BuildStatusResponse("NAK")
+			return p
+
+		p.BuildGetResponse( blocks, fsize, bsize, stripes )
+		return p
+
+	def blockEntries(self, rows, fsize, bsize):
+		"""Turns the block rows of a file into block map entries:
+		   index, offset, length, chunk id, live data nodes, checksum,
+		   codec and stored size.
+		"""
 
-		self.request.sendall(bytes(p.getEncodedPacket(), 'UTF-8'))
-		fname, fsize = p.getFileInfo()		
+		# Replicas of a block share its index and chunk id,
+		# replicas in dead nodes are left out
+		blocks = []
+		for idx, addr, port, cid, crc, codec, csize in rows:
+			if not (blocks and blocks[-1][0] == idx and blocks[-1][3] == cid):
+				offset = idx * bsize
+				length = min(bsize, fsize - offset)
+				blocks.append( [idx, offset, length, cid, [], crc, codec, length if csize is None else csize] )
+			if self.nodes.isAlive((addr, port)):
+				blocks[-1][4].append( (addr, port) )
+		return blocks
+
+	def stripesOf(self, db, fname, blocks, fsize, bsize):
+		"""Returns the stripes of the blocks of an erasure coded file,
+		   what its blocks are rebuilt from: (k, m, {stripe: [data blocks,
+		   parity blocks]}), the data blocks as block map entries and the
+		   parity blocks as parity index, chunk id, live data nodes,
+		   checksum and size.  And the stripes with less than k blocks in
+		   live data nodes.  None, None if the file is replicated.
+		"""
 
-		# -- End of Working
+		k, m, rows = db.GetStripes(fname, [block[0] for block in blocks])
+		if not k:
+			return None, None
+		stripes = {}
+		short = set()
+		for stripe, (data, parity) in rows.items():
+			data = self.blockEntries(data, fsize, bsize)
+			parity = [[pidx, cid, [(addr, port)] if self.nodes.isAlive((addr, port)) else [], crc, size]
+				for pidx, addr, port, cid, crc, size in parity]
+			# The last stripe of a file may be short, the blocks
+			# past the end of the file are zeros and never lost
+			left = k - len(data) + sum(1 for block in data if block[4]) + sum(1 for block in parity if block[2])
+			if left < k:
+				log.warning("Stripe %d of %s has %d of %d blocks left", stripe, fname, left, k)
+				short.add(stripe)
+			stripes[stripe] = [data, parity]
+		return (k, m, stripes), short
 
 	# Here we handle which packet request
 	# we're receiving :)		
-	def handle(self):
+	# Bulk jobs stat many files at once in a batch
+	def handle_stat(self, db, p):
+		"""Returns the size and block size of a file, or that it is a
+		   directory, NAK if it is not in the DFS.
+		"""
 
-		print("Waiting for instructions...")
-		# Establish a connection with the local database
-		db = mds_db("dfs.db")
-		db.Connect()
+		fname = clean_path(p.getFileName())
+		stat = db.StatFile(fname) if fname else None
+		sp = Packet()
+		if stat is None:
+			sp.BuildStatusResponse("NAK")
+		else:
+			sp.BuildStatResponse(fname, *stat)
+		return sp
 
-		# Define a packet object to decode packet messages
-		p = Packet()
 
-		# Receive a msg from the list, data-node, or copy clients
-		msg = self.request.recv(1024)
-		# print("handle()")
-		print (msg, type(msg))
-		
-		# Decode the packet received
-		p.DecodePacket(msg)
-		# print(f"PACKET: {p}")
+	# Directories are made by the puts of the files in them,
+	# or on their own
+	def handle_mkdir(self, db, p):
+		"""Creates a directory and the missing directories above it.
+		   ACK if it was created or was there, NAK if a file is in the way.
+		"""
+
+		path = clean_path(p.getFileName())
+		sp = Packet()
+		if path and db.MakeDir(path) is not None:
+			sp.BuildStatusResponse("ACK")
+		else:
+			sp.BuildStatusResponse("NAK")
+		return sp
+
+
+	# Renaming only changes the entry of the file or directory,
+	# whatever there is under it
+	def handle_rename(self, db, p):
+		"""Moves a file or directory to another path.  ACK if it was
+		   moved, NAK if the source is not there, the destination is or
+		   its directory is not.
+		"""
+
+		src, dst = p.getRename()
+		src, dst = clean_path(src or ""), clean_path(dst or "")
+		log.debug("Renaming %s to %s", src, dst)
+		sp = Packet()
+		if src and dst and db.Rename(src, dst):
+			sp.BuildStatusResponse("ACK")
+		else:
+			sp.BuildStatusResponse("NAK")
+		return sp
+
+
+	# Bulk jobs send the puts, gets, stats or block lists of
+	# many files in one batch, instead of one request each
+	def handle_batch(self, db, p):
+		"""Runs the requests of a batch in one database transaction,
+		   and answers the response of each one.  A request that fails
+		   is answered NAK and only its changes are rolled back.
+		"""
+
+		requests = p.getBatch()
+		log.debug("Batch of %d requests", len(requests))
+
+		# Batches that only read do not take the write lock
+		writes = any(r.getCommand() in BATCH_WRITES for r in requests)
+
+		responses = []
+		with db.Transaction(writes):
+			for request in requests:
+				sp = None
+				if request.getCommand() in BATCH_COMMANDS:
+					try:
+						with db.Transaction():
+							sp = self.run(db, request)
+					except (sqlite3.Error,) + BAD_REQUEST as e:
+						log.warning("Batch request failed: %s", e)
+				if sp is None:
+					sp = Packet()
+					sp.BuildStatusResponse("NAK")
+				responses.append(sp)
+
+		sp = Packet()
+		sp.BuildBatchResponse(responses)
+		return sp
+
+
+	# Anyone can ask the server what it has been doing,
+	# see stats.py
+	def handle_stats(self):
+		"""Returns the counters and latency histograms of the server,
+		   and how many data nodes it knows and are alive.
+		"""
+
+		stats = self.metrics.snapshot()
+		stats["data_nodes"] = len(self.nodes.nodes)
+		stats["data_nodes_alive"] = len(self.nodes.alive())
+		stats["log_dropped"] = logs.dropped()
+		sp = Packet()
+		sp.BuildStatsResponse(stats)
+		return sp
+
+
+	def dispatch(self, p, queued=None):
+		"""Runs the request in packet p, returns the response packet.
+		queued is when the request was queued for a worker, if it was."""
+
+		if queued is not None:
+			self.metrics.observe("queue", time.perf_counter() - queued)
+
+		# Stats do not need the database
+		cmd = p.getCommand()
+		if cmd == "stats":
+			return self.handle_stats()
+
+		try:
+			with self.metrics.timer("db." + str(cmd)):
+				# Establish a connection with the local database
+				db = mds_db(self.db_name)
+				db.Connect()
+
+				try:
+					return self.run(db, p)
+				finally:
+					db.Close()
+		except BAD_REQUEST as e:
+			# Whatever the request changed was rolled back
+			log.warning("Bad %s request: %s", cmd, e)
+			sp = Packet()
+			sp.BuildStatusResponse("NAK")
+			return sp
+
+	def run(self, db, p):
+		"""Runs the request in packet p with the database db, returns
+		the response packet."""
 
 		# Extract the command part of the received packet
 		cmd = p.getCommand()
 		addr = p.getAddr()
 		port = p.getPort()
 
-		print(f"ADDR: {addr} , PORT: {port} , CMD: {cmd}")
+		log.debug("ADDR: %s , PORT: %s , CMD: %s", addr, port, cmd)
 
 		# Invoke the proper action 
 		if   cmd == "reg":
 			# Registration client
-			print("registering")
-			self.handle_reg(db, p)
-
+			return self.handle_reg(db, p)
 
 		elif cmd == "list":
 			# Client asking for a list of files
-			print("listing")
-			self.handle_list(db)
-
+			return self.handle_list(db, p)
 
 		elif cmd == "put":
 			# Client asking for servers to put data
-			print("putting")
-			self.handle_put(db, p)
-
+			return self.handle_put(db, p)
 
 		elif cmd == "get":
 			# Client asking for servers to get data
-			print("getting")
-			self.handle_get(db, p)
+			return self.handle_get(db, p)
 
+		elif cmd == "hb":
+			# Data Node reporting its load
+			return self.handle_hb(db, p)
+
+		elif cmd == "dblks":
+			# Client telling where the blocks of a file are
+			return self.handle_dblks(db, p)
+
+		elif cmd == "have":
+			# Client asking which blocks are already stored
+			return self.handle_have(db, p)
+
+		elif cmd == "stat":
+			# Client asking the size of a file
+			return self.handle_stat(db, p)
+
+		elif cmd == "mkdir":
+			# Client making a directory
+			return self.handle_mkdir(db, p)
+
+		elif cmd == "rename":
+			# Client moving a file or directory
+			return self.handle_rename(db, p)
+
+		elif cmd == "abort":
+			# Client giving up on the put of a file
+			return self.handle_abort(db, p)
+
+		elif cmd == "batch":
+			# Client sending many requests at once
+			return self.handle_batch(db, p)
+
+		sp = Packet()
+		sp.BuildStatusResponse("NAK")
+		return sp
+
+
+class MetadataTCPHandler(socketserver.BaseRequestHandler):
+
+	def handle(self):
+
+		# Clients keep the connection open for more requests,
+		# until they close it or it is idle for too long
+		self.request.settimeout(IDLE_TIMEOUT)
+		# Responses sent in several writes are not held back
+		# waiting for the acknowledgement of the first one
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		reader = PacketReader(self.request)
+		metrics = self.server.service.metrics
+		metrics.add("connections")
+		metrics.add("connections_total")
+		try:
+			while True:
+				# Receive and decode a packet from the list, data-node, or copy clients
+				received = reader.received
+				try:
+					p = reader.readPacket()
+				except OSError:
+					return
+				if p is None:
+					return
+				# print("handle()")
+				log.debug("Request %s", p.packet)
+
+				# Latency is from the request received to the
+				# response sent
+				start = time.perf_counter()
+				sent = self.server.service.dispatch(p).sendPacket(self.request)
+				metrics.request(p.getCommand(), time.perf_counter() - start, reader.received - received, sent)
+		finally:
+			metrics.add("connections", -1)
+
+
+# Threaded mode: every connection is served in its own thread
+class ThreadedMetadataServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 1024
+
+	def __init__(self, address, service):
+		self.service = service
+		super().__init__(address, MetadataTCPHandler)
+
+
+# Asyncio mode: connections are served by the event loop, the
+# database work of each request runs in a pool of worker threads
+async def serve_asyncio(host, port, service, workers=WORKERS):
+	loop = asyncio.get_running_loop()
+	pool = ThreadPoolExecutor(max_workers=workers)
+
+	async def handle(reader, writer):
+		# Many requests per connection, until the client closes
+		# it or it is idle for too long
+		service.metrics.add("connections")
+		service.metrics.add("connections_total")
+		try:
+			while True:
+				header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), IDLE_TIMEOUT)
+				mtype, plen, payload_len = FRAME_HEADER.unpack(header)
+				# Requests to the metadata server have no payload,
+				# nothing longer than a packet is read into memory
+				if plen > MAX_PACKET or payload_len > MAX_PACKET:
+					break
+				body = await reader.readexactly(plen)
+				if payload_len:
+					await reader.readexactly(payload_len)
+
+				p = Packet()
+				p.DecodePacket(body, mtype, payload_len)
+				log.debug("Request %s", p.packet)
+
+				# The time waiting for a worker is the queue time
+				start = time.perf_counter()
+				sp = await loop.run_in_executor(pool, service.dispatch, p, start)
+				frame = sp.getFrame()
+				writer.write(frame)
+				await writer.drain()
+				service.metrics.request(p.getCommand(), time.perf_counter() - start, FRAME_HEADER.size + plen + payload_len, len(frame))
+		except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+			pass
+		finally:
+			service.metrics.add("connections", -1)
+			writer.close()
+
+	server = await asyncio.start_server(handle, host or None, port, backlog=1024, reuse_address=True)
+	async with server:
+		await server.serve_forever()
 
-		db.Close()
 
 if __name__ == "__main__":
 	HOST, PORT = "", 8000
+	MODE = "threaded"
 
 	if len(sys.argv) > 1:
 		try:
@@ -199,8 +756,28 @@ if __name__ == "__main__":
 		except:
 			usage()
 
-	server = socketserver.TCPServer((HOST, PORT), MetadataTCPHandler)
+	if len(sys.argv) > 2:
+		MODE = sys.argv[2]
+		if MODE not in MODES:
+			usage()
+
+	replication = REPLICATION
+	if len(sys.argv) > 3:
+		try:
+			replication = int(sys.argv[3])
+		except:
+			usage()
+		if replication < 1:
+			usage()
+
+	logs.setup()
+	service = MetadataService("dfs.db", replication)
+	log.info("Serving on port %d, %s, %d copies of each block", PORT, MODE, replication)
 
 	# Activate the server; this will keep running until you
 	# interrupt the program with Ctrl-C
-	server.serve_forever()
+	if MODE == "asyncio":
+		asyncio.run(serve_asyncio(HOST, PORT, service))
+	else:
+		server = ThreadedMetadataServer((HOST, PORT), service)
+		server.serve_forever()
@@ -0,0 +1,108 @@
+###############################################################################
+#
+# Filename: metrics.py
+#
+# Description:
+# 	Metrics support library for the DFS project.  The meta-data server
+# 	and the data nodes count what they do (requests, bytes, connections)
+# 	and keep latency histograms of it, and send it all in the answer of
+# 	a stats packet.  See stats.py.
+#
+# 	Recording is a lock and a few dictionary updates, cheap enough to
+# 	be always on.  Histograms have a bucket per power of two
+# 	microseconds, so percentiles are estimated to within a factor of 2.
+
+import time
+import threading
+import contextlib
+
+# Buckets of a latency histogram: bucket i counts the latencies of
+# less than 2**i microseconds, the last one counts all the slower ones
+BUCKETS = 32
+
+
+class Metrics:
+	"""Counters and latency histograms, by name.  Thread safe."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.counters = {}
+		# name: [count, total seconds, max seconds, buckets]
+		self.histograms = {}
+
+	def add(self, name, n=1):
+		"""Adds n to the counter name, i.e. -1 when a connection closes."""
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def _observe(self, name, seconds):
+		h = self.histograms.get(name)
+		if h is None:
+			h = self.histograms[name] = [0, 0.0, 0.0, [0] * BUCKETS]
+		h[0] += 1
+		h[1] += seconds
+		if seconds > h[2]:
+			h[2] = seconds
+		h[3][min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+	def observe(self, name, seconds):
+		"""Adds a latency, in seconds, to the histogram name."""
+		with self.lock:
+			self._observe(name, seconds)
+
+	def request(self, cmd, seconds, received, sent):
+		"""Records a request served: its latency and the bytes received
+		and sent for it."""
+		with self.lock:
+			self._observe("cmd." + str(cmd), seconds)
+			self.counters["bytes_in"] = self.counters.get("bytes_in", 0) + received
+			self.counters["bytes_out"] = self.counters.get("bytes_out", 0) + sent
+
+	@contextlib.contextmanager
+	def timer(self, name):
+		"""Times the with block into the histogram name."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+
+	def snapshot(self):
+		"""Returns the counters and a summary of the histograms: count,
+		total, mean, max and estimated percentiles in milliseconds, and
+		the buckets used, by their upper bound in microseconds."""
+		with self.lock:
+			counters = dict(self.counters)
+			histograms = {name: (h[0], h[1], h[2], list(h[3])) for name, h in self.histograms.items()}
+
+		summaries = {}
+		for name, (count, total, top, buckets) in histograms.items():
+			summary = {
+				"count": count,
+				"total_ms": round(total * 1000, 3),
+				"mean_ms": round(total * 1000 / count, 3),
+				"max_ms": round(top * 1000, 3),
+				"buckets": {1 << i: n for i, n in enumerate(buckets) if n},
+			}
+			for q in (50, 90, 99):
+				summary["p%d_ms" % q] = percentile(buckets, count, q / 100, top)
+			summaries[name] = summary
+
+		return {
+			"uptime_s": round(time.time() - self.started, 1),
+			"counters": counters,
+			"histograms": summaries,
+		}
+
+
+def percentile(buckets, count, q, top):
+	"""Estimates the q quantile of a histogram, in milliseconds, as the
+	upper bound of the bucket it falls in (never more than the max)."""
+	rank = q * count
+	seen = 0
+	for i, n in enumerate(buckets):
+		seen += n
+		if seen >= rank and n:
+			return round(min((1 << i) / 1000, top * 1000), 3)
+	return round(top * 1000, 3)
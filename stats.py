@@ -0,0 +1,53 @@
+###############################################################################
+#
+# Filename: stats.py
+#
+# Description:
+# This is a client-side Python script that asks a metadata server or a
+# data node for its metrics: requests, bytes in and out, connections,
+# and latency histograms of every command, of the database work
+# (meta-data server) and of the disk (data nodes).
+# The metrics are printed as JSON.
+
+# -------------- How to Run ---------------
+# 			    server:port
+# python3 stats.py localhost:1234
+# A data node:
+# python3 stats.py localhost:1111
+
+import sys
+import json
+from Packet import *
+
+# Connections to the servers, kept open for more requests
+# when getStats is called again
+connections = ConnectionPool()
+
+def usage():
+	print ("""Usage: python %s <server>:<port, default=8000>""" % sys.argv[0] )
+	sys.exit(0)
+
+# getStats returns the metrics of the server at address
+def getStats(address, pool=connections):
+	sp = Packet()
+	sp.BuildStatsPacket()
+	return pool.request(address, sp).getStats()
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) < 2:
+		usage()
+
+	server = sys.argv[1].split(":")
+	ip = server[0]
+	port = 8000
+	if len(server) == 2:
+		try:
+			port = int(server[1])
+		except ValueError:
+			usage()
+	elif len(server) > 2 or not ip:
+		usage()
+
+	print(json.dumps(getStats((ip, port)), indent=2))
@@ -52,7 +52,7 @@ print()
 print ("Adding blocks to the file, duplicate message if not the first time running")
 print ("this script")
 try:
-	db.AddBlockToInode("/hola/cheo.txt", [(id1, "1"), (id2, "1")])
+	db.AddBlockToInode("/hola/cheo.txt", [(0, "136.145.54.10", 80, "1"), (1, "136.145.54.11", 80, "1")])
 except:
 	print ("Won't duplicate")
 print()